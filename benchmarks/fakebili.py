@@ -0,0 +1,208 @@
+"""Local stand-in for the Bilibili api and CDN, for benchmarks.
+
+Serves the endpoints bget uses: favourite folder listing, video info, playurl,
+danmaku and covers, plus synthetic DASH tracks made with ffmpeg. A favourite
+folder id is its number of videos, every fifth video has two parts.
+
+    python benchmarks/fakebili.py --port 18932 --latency 0.05 --bandwidth 20 --error-rate 0.01
+
+Point bget at it with BGET_API_BASE and BGET_COMMENT_BASE, see pipeline.py.
+"""
+import os
+import re
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from dataclasses import dataclass, field
+from typing import List, Optional
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCK_SIZE = 64 * 1024
+COVER = b"\xff\xd8\xff\xe0" + bytes(16 * 1024)
+# a stalled stream response hangs this long before the connection is closed
+STALL_SECONDS = 10
+DANMAKU = "<?xml version=\"1.0\" encoding=\"UTF-8\"?><i>" + "".join(
+    f"<d p=\"{i}.0,1,25,16777215,0,0,0,0\">danmaku {i}</d>" for i in range(200)) + "</i>"
+
+
+@dataclass
+class Behaviour:
+    latency: float = 0.0
+    # bytes per second of every stream connection, 0 is unlimited
+    bandwidth: int = 0
+    error_rate: float = 0.0
+    # Range requests are answered with 206, otherwise the whole track is sent with 200
+    ranges: bool = True
+    # stream responses send this many bytes, then the connection is closed, or hangs first when stalled
+    cut_after: Optional[int] = None
+    stalled: bool = False
+    # Range header of every stream request, None without one
+    streamed: List[Optional[str]] = field(default_factory=list)
+
+
+def make_tracks(folder: str, video_size: int, audio_size: int) -> dict:
+    # two seconds of real media padded with a free box, which demuxers skip, up to the wanted size
+    tracks = {"video": os.path.join(folder, "video.m4s"), "audio": os.path.join(folder, "audio.m4s")}
+    fragmented = ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4"]
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=size=640x360:rate=25",
+                    "-t", "2", "-c:v", "mpeg4", *fragmented, tracks["video"]], check=True)
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+                    "-t", "2", "-c:a", "aac", *fragmented, tracks["audio"]], check=True)
+    data = dict()
+    for kind, size in [("video", video_size), ("audio", audio_size)]:
+        with open(tracks[kind], "rb") as f:
+            media = f.read()
+        padding = max(0, size - len(media) - 8)
+        data[kind] = media + (padding + 8).to_bytes(4, "big") + b"free" + bytes(padding) if padding > 0 else media
+    return data
+
+
+def video_info(aid: int, host: str) -> dict:
+    parts = 2 if aid % 5 == 0 else 1
+    return {
+        "aid": aid, "bvid": f"BV{aid}", "title": f"Video {aid}", "pubdate": 1600000000 + aid, "ctime": 1600000000,
+        "owner": {"name": f"up{aid % 7}", "mid": aid % 7}, "pic": f"http://{host}/cover/{aid}.jpg",
+        "pages": [{"cid": aid * 10 + p, "page": p + 1, "part": f"Part {p + 1}"} for p in range(parts)],
+    }
+
+
+def handler(tracks: dict, behaviour: Behaviour):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_):
+            pass
+
+        def send(self, body: bytes, content_type: str = "application/json", status: int = 200, headers=None,
+                 cut_after: Optional[int] = None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            if self.command == "HEAD":
+                return
+            if cut_after is not None and cut_after < len(body):
+                self.wfile.write(body[:cut_after])
+                self.wfile.flush()
+                if behaviour.stalled:
+                    time.sleep(STALL_SECONDS)
+                self.close_connection = True
+                return
+            if behaviour.bandwidth <= 0 or len(body) <= BLOCK_SIZE:
+                self.wfile.write(body)
+                return
+            started_at = time.monotonic()
+            view = memoryview(body)
+            for offset in range(0, len(body), BLOCK_SIZE):
+                self.wfile.write(view[offset:offset + BLOCK_SIZE])
+                ahead = (offset + BLOCK_SIZE) / behaviour.bandwidth - (time.monotonic() - started_at)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        def reply(self, data):
+            self.send(json.dumps({"code": 0, "message": "0", "data": data}).encode())
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_GET(self):
+            if behaviour.latency > 0:
+                time.sleep(behaviour.latency)
+            if random.random() < behaviour.error_rate:
+                return self.send(b"service unavailable", "text/plain", 503)
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            host = self.headers["Host"]
+            if url.path == "/x/v3/fav/resource/list":
+                count, page, size = int(query["media_id"]), int(query["pn"]), int(query.get("ps", 20))
+                if count < 0:
+                    # a deleted folder
+                    return self.send(json.dumps({"code": -404, "message": "not found", "data": None}).encode())
+                medias = [{"id": 1000 + i, "title": f"Video {1000 + i}", "type": 2, "fav_time": 1700000000 - i}
+                          for i in range((page - 1) * size, min(page * size, count))]
+                return self.reply({"info": {"media_count": count}, "medias": medias or None,
+                                   "has_more": page * size < count})
+            if url.path == "/x/v3/fav/resource/ids":
+                count = int(query["media_id"])
+                return self.reply([{"id": 1000 + i, "type": 2, "bv_id": f"BV{1000 + i}"} for i in range(count)])
+            if url.path == "/x/web-interface/view":
+                return self.reply(video_info(int(query["aid"]), host))
+            if url.path == "/x/player/playurl":
+                cid = query["cid"]
+                return self.reply({"dash": {
+                    "audio": [{"id": 30280, "base_url": f"http://{host}/stream/{cid}/audio.m4s"}],
+                    "video": [{"id": 80, "codecid": 7, "base_url": f"http://{host}/stream/{cid}/video.m4s"}],
+                }})
+            match = re.match(r"^/stream/\d+/(audio|video)\.m4s$", url.path)
+            if match:
+                return self.stream(tracks[match.group(1)])
+            if re.match(r"^/\d+\.xml$", url.path):
+                return self.send(DANMAKU.encode("utf-8"), "text/xml")
+            if url.path.startswith("/cover/"):
+                return self.send(COVER, "image/jpeg")
+            self.send(b"not found", "text/plain", 404)
+
+        def stream(self, data: bytes):
+            requested = self.headers.get("Range")
+            behaviour.streamed.append(requested)
+            if requested is None or not behaviour.ranges:
+                return self.send(data, "video/mp4", headers={"Accept-Ranges": "bytes"} if behaviour.ranges else None,
+                                 cut_after=behaviour.cut_after)
+            start, end = requested.split("=", 1)[1].split("-")
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+            self.send(data[start:end + 1], "video/mp4", 206,
+                      {"Content-Range": f"bytes {start}-{end}/{len(data)}", "Accept-Ranges": "bytes"},
+                      cut_after=behaviour.cut_after)
+    return Handler
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hang up on failed or stalled responses, that is part of the test
+        pass
+
+
+def listen(port: int, tracks: dict, behaviour: Behaviour) -> Server:
+    # tracks may be any bytes when only the transfer is looked at, port 0 picks a free one
+    server = Server(("127.0.0.1", port), handler(tracks, behaviour))
+    threading.Thread(target=server.serve_forever, name="fakebili", daemon=True).start()
+    return server
+
+
+def serve(port: int, behaviour: Behaviour, video_size: int, audio_size: int) -> ThreadingHTTPServer:
+    folder = tempfile.mkdtemp(prefix="bget-bench-")
+    tracks = make_tracks(folder, video_size, audio_size)
+    shutil.rmtree(folder)
+    return listen(port, tracks, behaviour)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=18932)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every response")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="MiB/s of every stream connection")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--video-size", type=float, default=8, help="video track size in MiB")
+    parser.add_argument("--audio-size", type=float, default=1, help="audio track size in MiB")
+    args = parser.parse_args()
+    behaviour = Behaviour(args.latency, int(args.bandwidth * 1024 * 1024), args.error_rate)
+    server = serve(args.port, behaviour, int(args.video_size * 1024 * 1024), int(args.audio_size * 1024 * 1024))
+    print(f"Serving on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Import time of the bget entry point, checked against a budget.
+
+Runs `python -X importtime -c "import bgetcli.bget"` in fresh interpreters and
+takes the best cumulative time of bgetcli.bget over the rounds. Exits with 1 if
+it is over the budget or if a module only downloads need was imported, so a CI
+job can run it as a test.
+
+    python benchmarks/import_time.py --budget-ms 60 --rounds 5
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the download stack, none of it is needed to parse the arguments
+FORBIDDEN = ["requests", "urllib3", "bgetlib", "toml", "pkg_resources", "sqlite3"]
+
+
+def measure(module: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, env=env, check=True).stderr.decode("utf-8")
+    modules = dict()
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name == " site":
+            # imported by the interpreter before the module, whatever the module does
+            modules.clear()
+        elif cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="bgetcli.bget")
+    parser.add_argument("--budget-ms", type=float, default=60.0, help="budget of the cumulative import time")
+    parser.add_argument("--rounds", type=int, default=5, help="the best round is taken, the first ones warm caches")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules shown")
+    args = parser.parse_args()
+
+    best = None
+    for _ in range(args.rounds):
+        modules = measure(args.module)
+        if best is None or modules[args.module] < best[args.module]:
+            best = modules
+    total = best[args.module] / 1000
+    print(f"{args.module}: {total:.1f} ms (budget {args.budget_ms:.1f} ms)")
+    for name, cumulative in sorted(best.items(), key=lambda item: -item[1])[1:args.top + 1]:
+        print(f"    {cumulative / 1000:>8.1f} ms  {name}")
+
+    failed = False
+    imported = [name for name in FORBIDDEN if name in best]
+    if len(imported) > 0:
+        print(f"FAIL: imported at startup: {', '.join(imported)}")
+        failed = True
+    if total > args.budget_ms:
+        print(f"FAIL: over budget by {total - args.budget_ms:.1f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""End to end throughput of bget against a local stand-in server.
+
+Starts the server of fakebili.py and runs `python -m bgetcli.bget` on favourite
+folders of every size with every number of jobs, each run in a fresh folder.
+Reports items/s, MB/s received from the stream server, CPU seconds and peak RSS
+of bget and the ffmpeg processes it starts. The tracks are padded with a free box
+that the merge drops, so the saved files are smaller than what was received.
+
+    python benchmarks/pipeline.py --sizes 20,100 --jobs 1,4,8 --bandwidth 10 --latency 0.02
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakebili import Behaviour, serve  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def folder_size(path: str) -> int:
+    total = 0
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(directory, filename))
+    return total
+
+
+def run(base: str, size: int, jobs: int, switches: list, extra: list, keep: bool) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bget-bench-run-")
+    config = os.path.join(workdir, "bench.toml")
+    with open(config, "w", encoding="utf-8") as f:
+        f.write(f"jobs = {jobs}\ncheckout-jobs = {jobs}\n\n[section.bench]\nid = {size}\noutdir = \"out\"\n"
+                f"switches = {json.dumps(switches)}\n")
+    env = dict(os.environ, BGET_API_BASE=base, BGET_COMMENT_BASE=base,
+               PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    command = [sys.executable, "-m", "bgetcli.bget", "--config", config, "--all-sections", "--progress", "none",
+               "--metrics-json", os.path.join(workdir, "metrics.json"), *extra]
+    with open(os.path.join(workdir, "bget.log"), "wb") as log:
+        wall_at = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # the usage of a waited child covers the ffmpeg processes it waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - wall_at
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"bget exited with {process.returncode}, see {os.path.join(workdir, 'bget.log')}")
+    with open(os.path.join(workdir, "metrics.json"), encoding="utf-8") as f:
+        metrics = json.load(f)
+    received = metrics["stages"]["transfer"]["bytes"]
+    retries = metrics["counters"].get("retries", 0)
+    saved = folder_size(os.path.join(workdir, "out"))
+    if not keep:
+        shutil.rmtree(workdir)
+    return {"size": size, "jobs": jobs, "seconds": round(wall, 3), "items_per_second": round(size / wall, 2),
+            "mb_per_second": round(received / 1024 ** 2 / wall, 2),
+            "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 2), "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+            "saved_mb": round(saved / 1024 ** 2, 1), "retries": retries}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="20,100", help="favourite folder sizes, comma separated")
+    parser.add_argument("--jobs", default="1,4,8", help="numbers of jobs, comma separated")
+    parser.add_argument("--switches", default="video,cover,danmaku")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every response")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="MiB/s of every stream connection")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--video-size", type=float, default=8, help="video track size in MiB")
+    parser.add_argument("--audio-size", type=float, default=1, help="audio track size in MiB")
+    parser.add_argument("--port", type=int, default=18932)
+    parser.add_argument("--json", metavar="<file>", default=None, help="also write the results as json")
+    parser.add_argument("--keep", action="store_true", help="keep the run folders for inspection")
+    parser.add_argument("bget_args", nargs=argparse.REMAINDER, help="extra bget arguments after --")
+    args = parser.parse_args()
+
+    behaviour = Behaviour(args.latency, int(args.bandwidth * 1024 * 1024), args.error_rate)
+    server = serve(args.port, behaviour, int(args.video_size * 1024 * 1024), int(args.audio_size * 1024 * 1024))
+    base = f"http://127.0.0.1:{server.server_port}"
+    extra = [arg for arg in args.bget_args if arg != "--"]
+    results = list()
+    try:
+        print(f"{'items':>6}{'jobs':>6}{'seconds':>10}{'items/s':>10}{'MB/s':>10}{'cpu s':>10}{'rss MB':>10}"
+              f"{'retries':>9}")
+        for size in [int(value) for value in args.sizes.split(",")]:
+            for jobs in [int(value) for value in args.jobs.split(",")]:
+                result = run(base, size, jobs, args.switches.split(","), extra, args.keep)
+                results.append(result)
+                print(f"{size:>6}{jobs:>6}{result['seconds']:>10.2f}{result['items_per_second']:>10.2f}"
+                      f"{result['mb_per_second']:>10.1f}{result['cpu_seconds']:>10.2f}{result['peak_rss_mb']:>10.1f}"
+                      f"{result['retries']:>9}")
+    finally:
+        server.shutdown()
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
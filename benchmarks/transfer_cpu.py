@@ -0,0 +1,94 @@
+"""CPU cost of the stream read loop, per GB received.
+
+Serves a payload from a local HTTP server in a child process and downloads it
+with the old iter_content loop and with bgetcli.transfer.read_chunks, writing to
+the null device. Only the CPU time of the downloading process is counted.
+
+    python benchmarks/transfer_cpu.py --size 1024 --rounds 3
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bgetcli.transfer import TransferOptions, read_chunks  # noqa: E402
+
+BLOCK = os.urandom(1024 * 1024)
+
+
+def serve(port: int, size: int, ready):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            remains = size
+            while remains > 0:
+                sent = min(remains, len(BLOCK))
+                self.wfile.write(BLOCK[:sent])
+                remains -= sent
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    ready.set()
+    server.serve_forever()
+
+
+def iter_content(r: requests.Response, chunk_size: int):
+    return r.iter_content(chunk_size=chunk_size)
+
+
+def fixed(r: requests.Response, chunk_size: int):
+    return read_chunks(r, TransferOptions(chunk_size, adaptive=False))
+
+
+def adaptive(r: requests.Response, chunk_size: int):
+    return read_chunks(r, TransferOptions(chunk_size, adaptive=True))
+
+
+def measure(url: str, reader, chunk_size: int, session: requests.Session):
+    cpu_at, wall_at = time.process_time(), time.perf_counter()
+    received = 0
+    with session.get(url, stream=True) as r, open(os.devnull, "wb") as output:
+        for chunk in reader(r, chunk_size):
+            output.write(chunk)
+            received += len(chunk)
+    return received, time.process_time() - cpu_at, time.perf_counter() - wall_at
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512, help="payload size in MiB")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=8192)
+    parser.add_argument("--port", type=int, default=18931)
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.port, args.size * 1024 * 1024, ready), daemon=True)
+    server.start()
+    ready.wait()
+    url = f"http://127.0.0.1:{args.port}/"
+    session = requests.Session()
+    try:
+        print(f"{'reader':<14}{'cpu s/GB':>10}{'MB/s':>10}")
+        for name, reader in [("iter_content", iter_content), ("fixed", fixed), ("adaptive", adaptive)]:
+            cpu_total, wall_total, received_total = 0.0, 0.0, 0
+            for _ in range(args.rounds):
+                received, cpu, wall = measure(url, reader, args.chunk_size, session)
+                cpu_total, wall_total, received_total = cpu_total + cpu, wall_total + wall, received_total + received
+            gigabytes = received_total / 1024 ** 3
+            print(f"{name:<14}{cpu_total / gigabytes:>10.3f}{received_total / 1024 ** 2 / wall_total:>10.1f}")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
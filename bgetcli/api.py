@@ -0,0 +1,72 @@
+import os
+from typing import Optional
+
+import bgetlib
+import requests
+from requests.adapters import HTTPAdapter
+
+from .limiter import CircuitBreaker, HostConnections
+
+TIMEOUT = 30
+# a local stand-in server can be used instead, such as the one of the benchmarks
+API_BASE = "https://api.bilibili.com"
+COMMENT_BASE = "https://comment.bilibili.com"
+# the api answers these when it starts refusing a client
+REJECTED_STATUS = {412, 429}
+REJECTED_CODES = {-412, -509, -352}
+
+
+class APIError(Exception):
+    def __init__(self, code: int, message: str = ""):
+        super().__init__(f"api error {code}: {message}" if message else f"api error {code}")
+        self.code = code
+
+
+class BilibiliAPI(bgetlib.BilibiliAPI):
+    def __init__(self, cookie_filename: Optional[str] = None, pool_size: int = 16,
+                 connections: Optional[HostConnections] = None, breaker: Optional[CircuitBreaker] = None):
+        super().__init__(cookie_filename)
+        self.api_base = os.environ.get("BGET_API_BASE", API_BASE).rstrip("/")
+        self.comment_base = os.environ.get("BGET_COMMENT_BASE", COMMENT_BASE).rstrip("/")
+        self.connections = connections or HostConnections()
+        self.breaker = breaker or CircuitBreaker()
+        # one keep-alive connection pool shared by api requests and stream transfers
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if self.cookies is not None:
+            self.session.cookies = self.cookies
+
+    @property
+    def account(self) -> str:
+        # the logged in user decides which qualities the stream urls offer
+        for cookie in self.cookies or []:
+            if cookie.name == "DedeUserID":
+                return cookie.value
+        return "guest"
+
+    def _request(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", TIMEOUT)
+        self.breaker.before()
+        with self.connections.hold(url):
+            r = self.session.get(url, **kwargs)
+        if r.status_code in REJECTED_STATUS:
+            self.breaker.record(True)
+        r.raise_for_status()
+        return r
+
+    def get_live_danmaku(self, cid: int) -> bytes:
+        return self._request(f"{self.comment_base}/{cid}.xml").content
+
+    def get_cover(self, url: str) -> bytes:
+        # through the shared session, unlike get_cover_picture which opens a connection for every picture
+        return self._request(url).content
+
+    def _interface_request(self, path, **kwargs) -> dict:
+        response = self._request(self.api_base + path, **kwargs).json()
+        code = response.get("code", 0)
+        self.breaker.record(code in REJECTED_CODES)
+        if code != 0:
+            raise APIError(code, response.get("message", ""))
+        return response
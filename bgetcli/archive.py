@@ -0,0 +1,171 @@
+import os
+import gzip
+import json
+import zlib
+import base64
+import struct
+import zipfile
+import threading
+from typing import Dict, Optional, Tuple
+
+ARCHIVE_FORMATS = ["zip", "jsonl"]
+EXTENSIONS = {"zip": "zip", "jsonl": "jsonl.gz"}
+_opened: Dict[str, "Archive"] = dict()
+_opened_lock = threading.Lock()
+# records added between two saves of the jsonl index, the records after the last save are read back on open
+INDEX_INTERVAL = 64
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+
+
+class Archive:
+    def __init__(self, path: str, archive_format: str):
+        self.path = path
+        self.format = archive_format
+        self.lock = threading.Lock()
+        # entry name to offset and length of its compressed record
+        self.entries: Dict[str, Tuple[int, int]] = dict()
+        self.unsaved = 0
+        if archive_format == "zip":
+            # entries are appended in place and the central directory is written on close,
+            # a bundle left without one by a crash is rebuilt from its entries
+            if os.path.exists(path) and not zipfile.is_zipfile(path):
+                self.recover_zip()
+            self.file = zipfile.ZipFile(path, "a", compression=zipfile.ZIP_DEFLATED)
+            for info in self.file.infolist():
+                self.entries[info.filename] = (info.header_offset, info.compress_size)
+        else:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self.entries = {name: tuple(entry) for name, entry in json.load(f).items()}
+            self.recover()
+            self.file = open(path, "ab")
+
+    @property
+    def index_path(self) -> str:
+        return self.path + ".index.json"
+
+    def recover_zip(self):
+        # every entry whose header and data reached the disk is read back from its local header
+        entries = list()
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(LOCAL_HEADER.size)
+                if len(header) < LOCAL_HEADER.size:
+                    break
+                signature, _, flags, method, _, _, crc, size, _, name_length, extra_length = LOCAL_HEADER.unpack(header)
+                # sizes written after the data are not known here, the rest of the bundle is dropped
+                if signature != b"PK\x03\x04" or flags & 0x08 or \
+                        method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    break
+                name = f.read(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+                f.seek(extra_length, os.SEEK_CUR)
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                try:
+                    data = zlib.decompress(data, -zlib.MAX_WBITS) if method == zipfile.ZIP_DEFLATED else data
+                except zlib.error:
+                    break
+                if zlib.crc32(data) != crc:
+                    break
+                entries.append((name, data, method))
+        with zipfile.ZipFile(self.path + ".tmp", "w") as bundle:
+            for name, data, method in entries:
+                bundle.writestr(name, data, method)
+        os.replace(self.path + ".tmp", self.path)
+
+    def recover(self):
+        # records appended after the last index save are indexed again, a record cut short by a crash is dropped
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.entries = {name: entry for name, entry in self.entries.items() if entry[0] + entry[1] <= size}
+        end = max((offset + length for offset, length in self.entries.values()), default=0)
+        if end == size:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(end)
+            tail = memoryview(f.read())
+        offset = 0
+        while offset < len(tail):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                record = decompressor.decompress(tail[offset:])
+            except zlib.error:
+                break
+            if not decompressor.eof:
+                break
+            length = len(tail) - offset - len(decompressor.unused_data)
+            self.entries[json.loads(record)["name"]] = (end + offset, length)
+            offset += length
+        if end + offset < size:
+            with open(self.path, "r+b") as f:
+                f.truncate(end + offset)
+        self.save_index()
+
+    def save_index(self):
+        with open(self.index_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self.unsaved = 0
+
+    @staticmethod
+    def open(outdir: str, section_name: Optional[str], archive_format: str) -> "Archive":
+        # sections sharing an outdir write their own bundle, runtimes of one section share it
+        filename = "{}.{}".format(section_name or "bget", EXTENSIONS[archive_format])
+        path = os.path.abspath(os.path.join(outdir, filename))
+        with _opened_lock:
+            if path not in _opened:
+                os.makedirs(outdir, exist_ok=True)
+                _opened[path] = Archive(path, archive_format)
+            return _opened[path]
+
+    @staticmethod
+    def close_all():
+        with _opened_lock:
+            for archive in _opened.values():
+                archive.close()
+            _opened.clear()
+
+    def has(self, name: str) -> bool:
+        return name in self.entries
+
+    def add(self, name: str, data: bytes, compress: bool = True) -> str:
+        with self.lock:
+            if self.format == "zip":
+                self.file.writestr(name, data, zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+                info = self.file.getinfo(name)
+                self.entries[name] = (info.header_offset, info.compress_size)
+            else:
+                # every record is a gzip member of its own, so it can be read back from its offset alone
+                try:
+                    record = {"name": name, "text": data.decode("utf-8")}
+                except UnicodeDecodeError:
+                    record = {"name": name, "base64": base64.b64encode(data).decode("ascii")}
+                member = gzip.compress(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n",
+                                       compresslevel=6 if compress else 1)
+                offset = self.file.tell()
+                self.file.write(member)
+                self.entries[name] = (offset, len(member))
+                self.unsaved += 1
+                if self.unsaved >= INDEX_INTERVAL:
+                    self.file.flush()
+                    self.save_index()
+        return f"{self.path}#{name}"
+
+    def read(self, name: str) -> bytes:
+        with self.lock:
+            if self.format == "zip":
+                return self.file.read(name)
+            offset, length = self.entries[name]
+            self.file.flush()
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                record = json.loads(gzip.decompress(f.read(length)))
+        if "text" in record:
+            return record["text"].encode("utf-8")
+        return base64.b64decode(record["base64"])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            if self.format != "zip":
+                self.save_index()
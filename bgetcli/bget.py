@@ -1,24 +1,63 @@
 import os
 import sys
-import shutil
 import argparse
-import bgetlib
-import pkg_resources
 import base64
-from typing import List
+import inspect
+import itertools
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple
 from enum import IntEnum
 
+# only what parsing the arguments needs is imported here, the download stack (requests, bgetlib,
+# toml, ffmpeg helpers) is imported by the commands using it, so -h, -v and failed checks start fast
+from .config import Config
+from .progress import MODES
+from .archive import ARCHIVE_FORMATS
+from .metrics import STAGES
+from .plan import ORDERS
+from .store import LINK_MODES
 from .utils import auto_format
-from .runtime import Config, Runtime, SectionHead
-from . import downloader
+
+if TYPE_CHECKING:
+    from .favsync import FavoriteSync
+    from .jobqueue import JobQueue
+    from .runtime import Runtime, SectionHead
 
 
-VERSION = pkg_resources.get_distribution("bget").version
 DEFAULT_CONFIG = Config(
     outdir=".",
     cookies="bilibili.com_cookies.txt",
+    cache=".bget-cache",
     chunk_size=8192,
+    adaptive_chunk=True,
+    connections=1,
     host=None,
+    hosts=[],
+    host_ranking_ttl=3600,
+    stall_timeout=20,
+    limit_rate=0,
+    host_connections=0,
+    jobs=1,
+    merge_jobs=os.cpu_count() or 1,
+    stream_merge=False,
+    checkout_jobs=1,
+    small_jobs=8,
+    checkout_rate=0,
+    incremental=False,
+    retries=3,
+    retry_budget=10,
+    retry_delay=2,
+    meta_max_age=0,
+    meta_cache_size=256,
+    offline_meta=False,
+    store=None,
+    store_link="auto",
+    archive=None,
+    scratch_dir=None,
+    min_free_space=0,
+    watch_interval=3600,
+    watch_jitter=0.1,
+    status_port=0,
+    order="favourite",
     formatter={
         "audio": "av{aid}-P{p:0>3d} {title}.{ext}",
         "video": "av{aid}-P{p:0>3d} {title}.mp4",
@@ -36,13 +75,29 @@ WINDOWS_FFMPEG = "KiBXaW5kb3dzIFtXaW5kb3dzIDEwIDIwSDIgYWJvdmUgb25seV06CiAgIGEuIF
 WINDOWS_FFMPEG = base64.b64decode(WINDOWS_FFMPEG).decode("utf-8").strip().splitlines()
 
 
+def version() -> str:
+    # importlib.metadata reads the installed metadata only, pkg_resources scans every installed distribution
+    from importlib.metadata import PackageNotFoundError, version as distribution_version
+    try:
+        return distribution_version("bget")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+class VersionAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        print(version())
+        parser.exit()
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(prog="bget", usage="bget [OPTIONS] <resource>",
                                      description="bget - a python bilibili favourites batch downloader",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("resource", metavar="<resource>", type=str,
-                        help="a bilibili resource, url, video id or section name")
-    parser.add_argument("-v", "--version", action="version", version=VERSION)
+    parser.add_argument("resource", metavar="<resource>", type=str, nargs="?", default=None,
+                        help="a bilibili resource, url, video id or section name, "
+                             "or watch to keep syncing every section of --config")
+    parser.add_argument("-v", "--version", action=VersionAction, nargs=0, help="show program's version number and exit")
 
     # common settings
     parser.add_argument("--config", metavar="<config>", type=str, default=None,
@@ -51,29 +106,108 @@ def parse_args() -> argparse.Namespace:
                         help="cookies file path")
     parser.add_argument("-o", "--outdir", action="store", metavar="<outdir>", type=str, default=None,
                         help="download output folder path")
+    parser.add_argument("--cache-dir", metavar="<cache-dir>", type=str, default=None,
+                        help="folder of local caches, such as favourite listings")
     parser.add_argument("--chunk-size", metavar="<chunk-size-byte>", type=int, default=None,
                         help="chunk size of downloader")
+    parser.add_argument("--fixed-chunk", action="store_true",
+                        help="always read <chunk-size> bytes at a time instead of adapting to the throughput")
+    parser.add_argument("--connections", metavar="<connections>", type=int, default=None,
+                        help="number of connections used to download one stream")
     parser.add_argument("--host", metavar="<host>", type=str, default=None,
                         help="override the host of stream CDN")
+    parser.add_argument("--hosts", metavar="<host,host,...>", type=str, default=None,
+                        help="candidate stream CDN hosts, the fastest is picked by probing them")
+    parser.add_argument("--stall-timeout", metavar="<seconds>", type=float, default=None,
+                        help="switch to the next host when a transfer stalls this long, 0 to wait forever")
+    parser.add_argument("--limit-rate", metavar="<rate>", type=str, default=None,
+                        help="limit the total download speed in bytes per second, K/M/G suffixes allowed, 0 for unlimited")
+    parser.add_argument("--host-connections", metavar="<connections>", type=int, default=None,
+                        help="limit concurrent connections to each host, 0 for unlimited")
+    parser.add_argument("-j", "--jobs", metavar="<jobs>", type=int, default=None,
+                        help="number of parallel download workers")
+    parser.add_argument("--merge-jobs", metavar="<merge-jobs>", type=int, default=None,
+                        help="number of ffmpeg processes merging in the background")
+    parser.add_argument("--stream-merge", action="store_true",
+                        help="pipe streams into ffmpeg while downloading instead of saving them first")
+    parser.add_argument("--small-jobs", metavar="<small-jobs>", type=int, default=None,
+                        help="number of parallel danmaku and cover downloads")
+    parser.add_argument("--checkout-jobs", metavar="<checkout-jobs>", type=int, default=None,
+                        help="number of parallel video info requests")
+    parser.add_argument("--checkout-rate", metavar="<requests-per-second>", type=float, default=None,
+                        help="limit video info requests per second, 0 for unlimited")
+    parser.add_argument("--retries", metavar="<retries>", type=int, default=None,
+                        help="retries of a request or transfer failing with a transient error")
+    parser.add_argument("--retry-delay", metavar="<seconds>", type=float, default=None,
+                        help="delay before the first retry, doubled on every retry after")
+    parser.add_argument("--meta-max-age", metavar="<seconds>", type=float, default=None,
+                        help="reuse cached video info fetched within this many seconds, 0 to always fetch")
+    parser.add_argument("--offline-meta", action="store_true",
+                        help="take video info from the metadata cache only, whatever its age")
+    parser.add_argument("--store", metavar="<store>", type=str, default=None,
+                        help="content store folder, outputs are saved there once and linked into every outdir")
+    parser.add_argument("--store-link", choices=LINK_MODES, default=None,
+                        help="how outputs are linked from the content store")
+    parser.add_argument("--archive", choices=ARCHIVE_FORMATS, default=None,
+                        help="save danmaku and covers into one compressed bundle of the section")
+    parser.add_argument("--scratch-dir", metavar="<scratch-dir>", type=str, default=None,
+                        help="folder for downloaded tracks waiting to be merged, the outdir if not set")
+    parser.add_argument("--min-free-space", metavar="<size>", type=str, default=None,
+                        help="downloads wait while they would leave less free disk space, K/M/G suffixes allowed")
+    parser.add_argument("--watch-interval", metavar="<seconds>", type=float, default=None,
+                        help="watch mode: seconds between two polls of a section")
+    parser.add_argument("--watch-jitter", metavar="<fraction>", type=float, default=None,
+                        help="watch mode: random share of the interval added or taken off every poll")
+    parser.add_argument("--status-port", metavar="<port>", type=int, default=None,
+                        help="watch mode: serve the daemon status as json on this local port, 0 to disable")
+    parser.add_argument("--order", choices=ORDERS, default=None,
+                        help="order of the downloads, any but favourite checks out the whole list first")
+    parser.add_argument("--plan", action="store_true",
+                        help="only list, check out and estimate the download size and time of every section")
     parser.add_argument("--meta", action="store_true", help="download metadata")
     parser.add_argument("--danmaku", action="store_true", help="download danmaku")
     parser.add_argument("--cover", action="store_true", help="download cover picture")
     parser.add_argument("--audio-only", action="store_true", help="download audio only")
     parser.add_argument("--log-include-date", action="store_true", help="include date in log")
+    parser.add_argument("--progress", choices=MODES, default="auto",
+                        help="progress display, auto draws bars on a terminal and prints a summary otherwise")
+    parser.add_argument("--metrics-json", metavar="<file>", type=str, default=None,
+                        help="write timings, bytes, retries and queue depths of every stage as json")
+    parser.add_argument("--metrics-prometheus", metavar="<file>", type=str, default=None,
+                        help="write the same metrics in prometheus text format")
+    parser.add_argument("--ignore-index", action="store_true",
+                        help="download again even if the completion index says an item is finished")
 
     # Section Mode
     parser.add_argument("-s", "--skip", metavar="<offset>", type=int, default=0,
                         help="skip <offset> videos if downloading a list, not work for downloading single video")
-    parser.add_argument("--section", action="store_true", help="enable section mode")
+    parser.add_argument("--section", action="store_true",
+                        help="enable section mode, <resource> can be a comma separated list of sections")
+    parser.add_argument("--all-sections", action="store_true",
+                        help="section mode: download every section in config within one process")
     parser.add_argument("--section-head", metavar="<head>", type=str, default="head.json",
                         help="section mode: path to head")
+    parser.add_argument("--incremental", action="store_true",
+                        help="cache favourite listings and only fetch pages with new items")
     parser.add_argument("--force-h264", action="store_true", default=False, help="section mode: force downloading h264 stream")
-    return parser.parse_args()
-
-
-def check_ffmpeg():
-    ffmpeg = shutil.which("ffmpeg")
-    if (ffmpeg is None) or (ffmpeg == ""):
+    args = parser.parse_args()
+    if args.resource == "watch":
+        if args.config is None:
+            parser.error("watch needs a config file with sections, see --config")
+        if args.plan:
+            parser.error("--plan does not work with watch")
+        args.all_sections = True
+    if args.all_sections:
+        args.section = True
+    elif args.resource is None:
+        parser.error("the following arguments are required: <resource>")
+    return args
+
+
+def check_ffmpeg(cache: str):
+    from .ffmpeg import locate
+    ffmpeg = locate(cache)
+    if ffmpeg is None:
         print("""
         bgetcli tool error: FFMPEG NOT FOUND !!!
         Please install ffmpeg first. You can download it by command below:
@@ -87,7 +221,7 @@ def check_ffmpeg():
         * macOS:            brew install ffmpeg
         """.format(*WINDOWS_FFMPEG))
         sys.exit(-1)
-    print(f"Found ffmpeg at: {ffmpeg}")
+    print(f"Found {ffmpeg['version'] or 'ffmpeg'} at: {ffmpeg['path']}")
 
 
 def ensure_cookies_exist(cookies_path: str):
@@ -110,6 +244,8 @@ class FLACState(IntEnum):
 
 
 def check_flac(cookies_file: str):
+    import bgetlib
+
     def check_flac_video(bvid: str):
         print(f"Checking FLAC with bvid: {bvid}", end="\t")
         bapi = bgetlib.BilibiliAPI(cookies_file)
@@ -145,132 +281,404 @@ def check_flac(cookies_file: str):
 
 def main():
     args = parse_args()
-    check_ffmpeg()
     ensure_cookies_exist(args.cookies)
     if args.resource == "check-account":
         return check_flac(args.cookies)
-    runtime = Runtime.factory(args, DEFAULT_CONFIG)
+    check_ffmpeg(args.cache_dir or DEFAULT_CONFIG.cache)
+    if args.resource == "watch":
+        from .watch import Watcher
+        return Watcher(args).run()
+    from .archive import Archive
+    from .jobqueue import QUEUE_FILENAME, JobQueue
+    from .plan import Throughput, order_videos, plan
+    from .runtime import Runtime, SectionHead
+    runtimes = Runtime.factory(args, DEFAULT_CONFIG)
+    if len(runtimes) == 0:
+        print("No section found in configuration")
+        return
+    if args.plan:
+        try:
+            plan(runtimes)
+        finally:
+            runtimes[0].scheduler.shutdown()
+            runtimes[0].meta.close()
+            Archive.close_all()
+        return
+    section_heads = list()
+    favorite_syncs = list()
+    pipelines = list()
+    queue = JobQueue(os.path.join(runtimes[0].config.cache, QUEUE_FILENAME))
+    # sections not listed to the end, their head stays where it was
+    unlisted = set()
+    for runtime in runtimes:
+        try:
+            section_head, favorite_sync, download_tasks = list_section(runtime)
+        except Exception as e:
+            fail_listing(runtime, e, unlisted)
+            continue
+        if not isinstance(download_tasks, list):
+            download_tasks = guard_listing(runtime, download_tasks, unlisted)
+        if runtime.section_name is not None:
+            download_tasks = requeue(runtime, queue, download_tasks)
+        section_heads.append(section_head)
+        if favorite_sync is not None:
+            favorite_syncs.append(favorite_sync)
+        videos = order_videos(runtime, checkout_videos(runtime, download_tasks))
+        total = len(download_tasks) if isinstance(download_tasks, list) else None
+        pipelines.append(download_videos(runtime, videos, total))
+
+    scheduler = runtimes[0].scheduler
+    try:
+        interleave(pipelines)
+        scheduler.wait()
+    finally:
+        scheduler.shutdown()
+
+    runtimes[0].meta.close()
+    Archive.close_all()
+    SectionHead.write_all([head for head in section_heads if head.section not in unlisted])
+    for favorite_sync in favorite_syncs:
+        if favorite_sync.runtime.section_name not in unlisted:
+            favorite_sync.commit()
+    for runtime in runtimes:
+        # a section not listed to the end did not try its queued items either
+        if runtime.section_name is not None and runtime.section_name not in unlisted:
+            settle(runtime, queue)
+    report(runtimes[0])
+    write_metrics(runtimes[0])
+    Throughput(runtimes[0].config.cache).record(*runtimes[0].metrics.transferred())
+    runtimes[0].log("All done.")
+
+
+def fail_listing(runtime: "Runtime", e: Exception, unlisted: set):
+    from .retry import describe_error
+    from .runtime import ReportEntry
+    reason = f"listing: {describe_error(e)}"
+    # reported with the resource instead of a video, the other sections go on
+    runtime.report.error.append(ReportEntry(None, f"{runtime.resource_type}:{runtime.resource_id}", reason))
+    runtime.log(f"Failed: {reason}")
+    unlisted.add(runtime.section_name)
+
+
+def guard_listing(runtime: "Runtime", tasks: Iterable[dict], unlisted: set) -> Iterator[dict]:
+    try:
+        yield from tasks
+    except Exception as e:
+        fail_listing(runtime, e, unlisted)
+
+
+def requeue(runtime: "Runtime", queue: "JobQueue", tasks: Iterable[dict]) -> Iterable[dict]:
+    # items failed in the last runs go first, the listing stops at the head before reaching them
+    queued = queue.pending(runtime.section_name)
+    if len(queued) == 0:
+        return tasks
+    runtime.log(f"Retrying {len(queued)} items failed in the last runs")
+    known = set(task["id"] for task in queued)
+    listed = (task for task in tasks if task["id"] not in known)
+    if isinstance(tasks, list):
+        return queued + list(listed)
+    return itertools.chain(queued, listed)
+
+
+def settle(runtime: "Runtime", queue: "JobQueue"):
+    # the head has moved past the failed items, they wait in the queue for the next run
+    if len(runtime.failed) == 0 and len(queue.pending(runtime.section_name)) == 0:
+        return
+    queue.add(runtime.section_name, [{"id": entry.id, "title": entry.title} for entry in runtime.failed])
+    for task in queue.finish(runtime.section_name, set(entry.id for entry in runtime.failed)):
+        runtime.log(f"Giving up av{task['id']} after {task['attempts']} attempts")
+
+
+def list_section(runtime: "Runtime", tick: bool = True) -> Tuple["SectionHead", Optional["FavoriteSync"], Iterable[dict]]:
+    # a folder listed page by page is returned as an iterator, the checkout starts after the first page,
+    # a dry run leaves the head without a tick, so it is never written
+    from .favsync import FavoriteSync
+    from .runtime import SectionHead
     section_head = SectionHead(runtime)
-    download_tasks = generate_tasks(runtime, section_head)
-    section_head.tick()
+    favorite_sync = None
+    if runtime.config.incremental and runtime.resource_type == "fav":
+        favorite_sync = FavoriteSync(runtime, runtime.resource_id)
+    download_tasks = generate_tasks(runtime, section_head, favorite_sync)
+    if tick:
+        section_head.tick()
+    return section_head, favorite_sync, download_tasks
+
 
-    videos = checkout_videos(runtime, download_tasks)
-    download_videos(runtime, videos)
+def write_metrics(runtime: "Runtime"):
+    if runtime.args.metrics_json is not None:
+        runtime.metrics.write_json(runtime.args.metrics_json)
+        runtime.log(f"Metrics written to {runtime.args.metrics_json}")
+    if runtime.args.metrics_prometheus is not None:
+        runtime.metrics.write_prometheus(runtime.args.metrics_prometheus)
+        runtime.log(f"Metrics written to {runtime.args.metrics_prometheus}")
 
-    section_head.write()
-    report(runtime)
-    runtime.log("All done.")
+
+def interleave(pipelines: List[Iterator]):
+    # take one video from every section in turn, so sections share the workers fairly
+    active = list(pipelines)
+    while len(active) > 0:
+        for pipeline in list(active):
+            if next(pipeline, None) is None:
+                active.remove(pipeline)
 
 
 def logger_tag(tag: str):
     def decorator(func):
-        def wrapper(runtime: Runtime, *values, **kwargs):
+        def wrapper(runtime: "Runtime", *values, **kwargs):
             runtime.log_tags.append(tag)
             result = func(runtime, *values, **kwargs)
             runtime.log_tags.pop()
             return result
+
+        def generator_wrapper(runtime: "Runtime", *values, **kwargs):
+            # generators are resumed by their consumer, restore the tags of the caller on every step
+            tags = list(runtime.log_tags) + [tag]
+            generator = func(runtime, *values, **kwargs)
+
+            def resume():
+                while True:
+                    outer_tags = list(runtime.log_tags)
+                    runtime.log_tags[:] = tags
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        runtime.log_tags[:] = outer_tags
+                    yield item
+            return resume()
+
+        if inspect.isgeneratorfunction(func):
+            return generator_wrapper
         return wrapper
     return decorator
 
 
-def generate_tasks(runtime: Runtime, section_head: SectionHead):
+def generate_tasks(runtime: "Runtime", section_head: "SectionHead",
+                   favorite_sync: Optional["FavoriteSync"] = None) -> Iterable[dict]:
     tasks = list()
     if runtime.resource_type == "fav":
-        if runtime.section_name is None:
-            tasks = runtime.bapi.get_favorites_all(runtime.resource_id)
+        if favorite_sync is not None:
+            with runtime.metrics.time("listing"):
+                tasks = favorite_sync.refresh()
+            if runtime.section_name is not None:
+                tasks = favorite_sync.since(section_head)
+        elif runtime.section_name is None:
+            tasks = list_favorites(runtime, None)
         else:
-            tasks = runtime.bapi.get_favorites_since(runtime.resource_id, section_head.read())
+            tasks = list_favorites(runtime, section_head.read())
         tasks = skip(runtime, tasks, runtime.args.skip)
     if runtime.resource_type == "video":
         tasks = [{"id": runtime.resource_id}]
     return tasks
 
 
+def list_favorites(runtime: "Runtime", since: Optional[int]) -> Iterator[dict]:
+    # the next page is fetched when the checkout stage asks for more, the folder is listed newest first
+    from .favsync import FavoriteSync
+    page = 1
+    while True:
+        with runtime.metrics.time("listing"):
+            medias = runtime.retry.call(("fav", runtime.resource_id, page), runtime.bapi.get_favorites,
+                                        runtime.resource_id, page, logger=runtime.log)
+        if len(medias) == 0:
+            return
+        for media in medias:
+            if since is not None and media["fav_time"] < since:
+                return
+            yield FavoriteSync.compact(media, page)
+        page += 1
+
+
 @logger_tag("skip")
-def skip(runtime: Runtime, tasks: List[dict], skip_count: int) -> List[dict]:
+def skip(runtime: "Runtime", tasks: Iterable[dict], skip_count: int) -> Iterable[dict]:
     if skip_count == 0:
         return tasks
+    from .runtime import ReportEntry
     runtime.log(f"Skipping {skip_count} items below:")
-    skipped = tasks[:skip_count]
-    remains = tasks[skip_count:]
-    runtime.report.skip = skipped
-    for task in skipped:
+    remains = iter(tasks)
+    for _, task in zip(range(skip_count), remains):
+        runtime.report.skip.append(ReportEntry.of(task))
         runtime.log(f"Skip: av{task['id']}: {task['title']:20}")
-    return remains
+    return list(remains) if isinstance(tasks, list) else remains
 
 
 @logger_tag("checkout")
-def checkout_videos(runtime: Runtime, tasks: List) -> List[dict]:
-    videos = list()
-    for i in range(len(tasks)):
-        task = tasks[i]
-        aid = task["id"]
-        # noinspection PyBroadException
+def checkout_videos(runtime: "Runtime", tasks: Iterable[dict]) -> Iterator[dict]:
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from .api import APIError
+    from .limiter import TokenBucket
+    from .retry import describe_error
+    from .runtime import ReportEntry
+    limiter = TokenBucket(runtime.config.checkout_rate)
+    jobs = max(1, runtime.config.checkout_jobs)
+    checked = 0
+
+    def checkout(aid: int) -> dict:
+        if not runtime.config.offline_meta:
+            limiter.acquire()
+        with runtime.metrics.time("checkout"):
+            video = runtime.meta.get(aid, lambda: runtime.retry.call(aid, runtime.bapi.get_video, aid,
+                                                                     logger=runtime.log))
+        if not video or len(video.get("pages") or []) == 0:
+            raise ValueError("no video info in api response")
+        return video
+
+    def collect(task: dict, future) -> Iterator[dict]:
+        nonlocal checked
         try:
-            video = runtime.bapi.get_video(aid)
-        except:
-            runtime.report.inaccessible.append(task)
-            runtime.log(f"Inaccessible: av{aid}: {task['title']:20}")
-            continue
-        videos.append(video)
-    runtime.log(f"Checkout {len(videos)} videos, {len(runtime.report.inaccessible)} inaccessible.")
-    return videos
+            video = future.result()
+        except APIError as e:
+            # deleted, hidden or region locked, asking again does not help
+            runtime.report.inaccessible.append(ReportEntry.of(task))
+            runtime.log(f"Inaccessible: av{task['id']}: {task.get('title', ''):20} {e}")
+            return
+        except Exception as e:
+            reason = f"checkout: {describe_error(e)}"
+            runtime.fail(ReportEntry.of(task, reason))
+            runtime.log(f"Failed: av{task['id']}: {reason}")
+            return
+        checked += 1
+        yield video
+
+    # videos are handed to the download stage in list order as soon as they are ready
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="bget-checkout") as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append((task, pool.submit(checkout, task["id"])))
+            if len(pending) >= jobs * 2:
+                yield from collect(*pending.popleft())
+        while len(pending) > 0:
+            yield from collect(*pending.popleft())
+    runtime.log(f"Checkout {checked} videos, {len(runtime.report.inaccessible)} inaccessible, "
+                f"{runtime.meta.hits} from metadata cache so far.")
 
 
 @logger_tag("dl")
-def download_videos(runtime: Runtime, videos: List):
-    for i in range(len(videos)):
-        video = videos[i]
+def download_videos(runtime: "Runtime", videos: Iterator[dict], total: Optional[int]) -> Iterator[dict]:
+    # total is None for a listing still going on
+    from .retry import describe_error
+    from .runtime import MultipartEntry, ReportEntry
+    for i, video in enumerate(videos):
         if len(video["pages"]) > 1:
-            runtime.report.multipart.append(video)
-        runtime.log(f"Start downloading {i+1}/{len(videos)} https://b23.tv/av{video['aid']}")
+            runtime.report.multipart.append(MultipartEntry(video))
+        runtime.log(f"Start downloading {i+1}" + (f"/{total}" if total is not None else "") +
+                    f" https://b23.tv/av{video['aid']}")
         runtime.log_tags.append(f"av{video['aid']}")
-        download_video(runtime, video)
+        try:
+            download_video(runtime, video)
+        except Exception as e:
+            # jobs already scheduled for the video still run, the rest of it is reported
+            reason = f"schedule: {describe_error(e)}"
+            runtime.fail(ReportEntry(video["aid"], video["title"], reason))
+            runtime.log(f"Failed: {reason}")
         runtime.log_tags.pop()
+        yield video
+        # the next video is checked out once the workers have room for it
+        runtime.scheduler.admit()
 
 
-def download_video(runtime: Runtime, video: dict):
+def download_video(runtime: "Runtime", video: dict):
+    from . import downloader
     runtime.log(auto_format("av{aid} {bvid} {parts}P up='{up}' (uid={up_uid})", video))
     runtime.log(auto_format("Title: {title}", video))
+    jobs = list()
+
+    def pending(switch: str, p: Optional[int] = None) -> bool:
+        if switch not in runtime.config.switches:
+            return False
+        cid = video["pages"][p]["cid"] if p is not None else 0
+        if (not runtime.args.ignore_index) and \
+                runtime.index.done(video["aid"], cid, switch, downloader.output_path(runtime, switch, video, p)):
+            runtime.log(f"Already finished: {switch}" + (f" P{p+1}" if p is not None else ""))
+            return False
+        if downloader.archived(runtime, switch) and (not runtime.args.ignore_index) and \
+                runtime.archive.has(downloader.archive_entry(runtime, switch, video, p)):
+            runtime.log(f"Already archived: {switch}" + (f" P{p+1}" if p is not None else ""))
+            return False
+        key = downloader.store_key(runtime, switch, video, p)
+        if key is None:
+            return True
+        if downloader.link_stored(runtime, switch, video, p) is not None:
+            return False
+        producer = runtime.store.producing(key)
+        if producer is not None:
+            jobs.append(runtime.scheduler.track(downloader.link_when_done(runtime, switch, video, p, producer)))
+            return False
+        return True
+
+    def submit(switch: str, p: Optional[int], *args):
+        job = runtime.scheduler.submit(runtime, getattr(downloader, f"download_{switch}"), video, p, *args,
+                                       small=switch in downloader.ARCHIVED)
+        key = downloader.store_key(runtime, switch, video, p)
+        if key is not None:
+            runtime.store.claim(key, job)
+        jobs.append(job)
+
     for p in range(len(video["pages"])):
         runtime.log(auto_format("Part {p}/{parts} cid={cid}: {part_name}", video, p))
-        if "audio" in runtime.config.switches:
-            downloader.download_audio(runtime, video, p)
-        if "video" in runtime.config.switches:
-            downloader.download_video(runtime, video, p)
-        if "danmaku" in runtime.config.switches:
-            downloader.download_danmaku(runtime, video, p)
-    if "cover" in runtime.config.switches:
-        downloader.download_cover(runtime, video)
-    if "meta" in runtime.config.switches:
-        downloader.download_meta(runtime, video)
-    runtime.log(f"Done download av{video['aid']}")
-
-
-def report(runtime: Runtime):
+        stream_switches = [switch for switch in ["audio", "video"] if pending(switch, p)]
+        if len(stream_switches) > 0:
+            session = downloader.StreamSession(runtime, video, p, stream_switches)
+        for switch in stream_switches:
+            submit(switch, p, session)
+        if pending("danmaku", p):
+            submit("danmaku", p)
+    if pending("cover"):
+        submit("cover", None)
+    if pending("meta"):
+        submit("meta", None)
+
+    def done():
+        if all((not job.cancelled()) and (job.exception() is None) and (job.result() is not None) for job in jobs):
+            runtime.log(f"Done download av{video['aid']}")
+    runtime.scheduler.when_done(jobs, done)
+
+
+def report(runtime: "Runtime"):
+    deduplicated = sum(entry.size for entry in runtime.report.deduplicated)
     print("=" * 80)
     print(f"""Download Report
     Skip: {len(runtime.report.skip)}
     Inaccessible: {len(runtime.report.inaccessible)}
+    Removed: {len(runtime.report.removed)}
     Error: {len(runtime.report.error)}
     Multipart: {len(runtime.report.multipart)}
+    Deduplicated: {len(runtime.report.deduplicated)} files, {deduplicated / 1024 / 1024:.2f}M
     """)
 
     print("\n====== Skip ========")
-    for task in runtime.report.skip:
-        print(f"https://b23.tv/av{task['id']:<20} {task['title']:20}")
+    for entry in runtime.report.skip:
+        print(f"https://b23.tv/av{entry.id:<20} {entry.title:20}")
 
     print("\n=== Inaccessible ===")
-    for task in runtime.report.inaccessible:
-        print(f"https://b23.tv/av{task['id']:<20} {task['title']:20}")
+    for entry in runtime.report.inaccessible:
+        print(f"https://b23.tv/av{entry.id:<20} {entry.title:20}")
+
+    print("\n====== Removed =====")
+    for entry in runtime.report.removed:
+        print(f"https://b23.tv/av{entry.id:<20} {entry.title:20}")
+
+    print("\n====== Error =======")
+    for entry in runtime.report.error:
+        if entry.id is None:
+            print(f"{entry.title:<37} {'':20} {entry.reason}")
+            continue
+        print(f"https://b23.tv/av{entry.id:<20} {entry.title:20} {entry.reason}")
+
+    print("\n====== Stages ======")
+    stages = runtime.metrics.summary()["stages"]
+    for stage in STAGES:
+        entry = stages[stage]
+        print(f"{stage:<10} count={entry['count']:<8} failed={entry['failed']:<6} total={entry['seconds']:.1f}s "
+              f"p50<={entry['p50']}s p90<={entry['p90']}s max={entry['max']}s {entry['bytes'] / 1024 / 1024:.2f}M")
 
-    # print("\n====== Error =======")
     print("\n==== Multipart =====")
-    for video in runtime.report.multipart:
-        print(f"https://b23.tv/av{video['aid']:<20} {len(video['pages'])}P {video['title']:16}")
-        for p in range(len(video["pages"])):
-            part = video["pages"][p]
-            print(f"      P{p+1:<5} cid={part['cid']:<15} {part['part']:20}")
+    for entry in runtime.report.multipart:
+        print(f"https://b23.tv/av{entry.id:<20} {len(entry.parts)}P {entry.title:16}")
+        for p, (cid, part_name) in enumerate(entry.parts):
+            print(f"      P{p+1:<5} cid={cid:<15} {part_name:20}")
 
     print("\n\nEnd of Download Report")
     print("=" * 80, "\n")
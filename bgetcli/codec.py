@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+from typing import BinaryIO, Callable, List, Union
+from bgetlib.models import QualityOptions
+
+from .ffmpeg import executable
+
+PIPES_SUPPORTED = hasattr(os, "mkfifo")
+StreamWriter = Callable[[BinaryIO], None]
+
+
+def _run(*args: str) -> subprocess.CompletedProcess:
+    command = [executable(), "-y", "-hide_banner", *args]
+    return subprocess.run(command, capture_output=True, check=True)
+
+
+def audio_extension(quality: QualityOptions) -> str:
+    if quality.flac_audio:
+        return "flac"
+    if quality.dolby_audio:
+        return "ac3"
+    return "aac"
+
+
+def partial_path(dest: str) -> str:
+    # ffmpeg picks the container by the extension, the hidden name keeps it
+    directory, filename = os.path.split(dest)
+    return os.path.join(directory, f".{filename}.part{os.path.splitext(filename)[1]}")
+
+
+def _remove(path: str):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _run_to(dest: str, *args: str) -> subprocess.CompletedProcess:
+    # the output is renamed into place once ffmpeg is done, a crash never leaves a truncated file under its name
+    partial = partial_path(dest)
+    try:
+        result = _run(*args, partial)
+    except BaseException:
+        _remove(partial)
+        raise
+    os.replace(partial, dest)
+    return result
+
+
+def merge(audio: str, video: str, dest: str) -> subprocess.CompletedProcess:
+    return _run_to(dest, "-i", audio, "-i", video, "-c", "copy", "-strict", "experimental")
+
+
+def extract_audio(audio: str, dest: str) -> subprocess.CompletedProcess:
+    return _run_to(dest, "-i", audio, "-vn", "-c", "copy")
+
+
+def _unblock(fifo: str):
+    # a writer still waiting for ffmpeg to open its pipe is released, its writes then fail with a broken pipe
+    try:
+        os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+
+def merge_streams(audio: Union[str, StreamWriter], video: Union[str, StreamWriter],
+                  dest: str) -> subprocess.CompletedProcess:
+    workdir = tempfile.mkdtemp(prefix="bget-")
+    inputs: List[str] = list()
+    writers = list()
+    for name, source in [("audio", audio), ("video", video)]:
+        if isinstance(source, str):
+            inputs.append(source)
+            continue
+        fifo = os.path.join(workdir, name)
+        os.mkfifo(fifo)
+        inputs.append(fifo)
+        writers.append((fifo, source))
+
+    errors: List[BaseException] = list()
+
+    def feed(fifo: str, writer: StreamWriter):
+        # noinspection PyBroadException
+        try:
+            with open(fifo, "wb") as f:
+                writer(f)
+        except BrokenPipeError:
+            pass  # ffmpeg quit early, its exit code tells why
+        except BaseException as e:
+            errors.append(e)
+
+    partial = partial_path(dest)
+    command = [executable(), "-y", "-hide_banner", "-i", inputs[0], "-i", inputs[1],
+               "-c", "copy", "-strict", "experimental", partial]
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        threads = [threading.Thread(target=feed, args=writer, daemon=True) for writer in writers]
+        for thread in threads:
+            thread.start()
+        stdout, stderr = process.communicate()
+        for fifo, _ in writers:
+            _unblock(fifo)
+        for thread in threads:
+            thread.join()
+    except BaseException:
+        _remove(partial)
+        raise
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if len(errors) > 0 or process.returncode != 0:
+        _remove(partial)
+        if len(errors) > 0:
+            raise errors[0]
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    os.replace(partial, dest)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
@@ -0,0 +1,184 @@
+import argparse
+from dataclasses import dataclass
+from typing import Optional, Dict, List
+from .utils import list_unique, parse_rate
+
+
+@dataclass
+class Config:
+    outdir: str
+    cookies: str
+    cache: str
+    chunk_size: int
+    adaptive_chunk: bool
+    connections: int
+    host: Optional[str]
+    hosts: List[str]
+    host_ranking_ttl: float
+    stall_timeout: float
+    limit_rate: float
+    host_connections: int
+    jobs: int
+    merge_jobs: int
+    small_jobs: int
+    stream_merge: bool
+    checkout_jobs: int
+    checkout_rate: float
+    incremental: bool
+    retries: int
+    retry_budget: int
+    retry_delay: float
+    meta_max_age: float
+    meta_cache_size: int
+    offline_meta: bool
+    store: Optional[str]
+    store_link: str
+    archive: Optional[str]
+    scratch_dir: Optional[str]
+    min_free_space: float
+    watch_interval: float
+    watch_jitter: float
+    status_port: int
+    order: str
+    switches: List[str]
+    formatter: Dict[str, str]
+
+    def load(self, raw_config: dict, section_name: Optional[str] = None):
+        override_config = raw_config
+        if section_name is not None:
+            override_config = raw_config.get("section", {}).get(section_name, {})
+        self.outdir = override_config.get("outdir", self.outdir)
+        self.cookies = override_config.get("cookies", self.cookies)
+        self.cache = override_config.get("cache", self.cache)
+        self.chunk_size = override_config.get("chunk-size", self.chunk_size)
+        self.adaptive_chunk = override_config.get("adaptive-chunk", self.adaptive_chunk)
+        self.connections = override_config.get("connections", self.connections)
+        self.host = override_config.get("host", self.host)
+        self.hosts = override_config.get("hosts", self.hosts)
+        self.host_ranking_ttl = override_config.get("host-ranking-ttl", self.host_ranking_ttl)
+        self.stall_timeout = override_config.get("stall-timeout", self.stall_timeout)
+        self.limit_rate = parse_rate(override_config.get("limit-rate", self.limit_rate))
+        self.host_connections = override_config.get("host-connections", self.host_connections)
+        self.jobs = override_config.get("jobs", self.jobs)
+        self.merge_jobs = override_config.get("merge-jobs", self.merge_jobs)
+        self.small_jobs = override_config.get("small-jobs", self.small_jobs)
+        self.stream_merge = override_config.get("stream-merge", self.stream_merge)
+        self.checkout_jobs = override_config.get("checkout-jobs", self.checkout_jobs)
+        self.checkout_rate = override_config.get("checkout-rate", self.checkout_rate)
+        self.incremental = override_config.get("incremental", self.incremental)
+        self.retries = override_config.get("retries", self.retries)
+        self.retry_budget = override_config.get("retry-budget", self.retry_budget)
+        self.retry_delay = override_config.get("retry-delay", self.retry_delay)
+        self.meta_max_age = override_config.get("meta-max-age", self.meta_max_age)
+        self.meta_cache_size = override_config.get("meta-cache-size", self.meta_cache_size)
+        self.offline_meta = override_config.get("offline-meta", self.offline_meta)
+        self.store = override_config.get("store", self.store)
+        self.store_link = override_config.get("store-link", self.store_link)
+        self.archive = override_config.get("archive", self.archive)
+        self.scratch_dir = override_config.get("scratch-dir", self.scratch_dir)
+        self.min_free_space = parse_rate(override_config.get("min-free-space", self.min_free_space))
+        self.watch_interval = override_config.get("watch-interval", self.watch_interval)
+        self.watch_jitter = override_config.get("watch-jitter", self.watch_jitter)
+        self.status_port = override_config.get("status-port", self.status_port)
+        self.order = override_config.get("order", self.order)
+        self.switches = list_unique(override_config.get("switches", self.switches))
+        for key in ["meta", "audio", "video", "cover", "danmaku"]:
+            self.formatter[key] = override_config.get("formatter-" + key, self.formatter[key])
+
+    def load_args(self, args: argparse.Namespace):
+        self.cookies = args.cookies or self.cookies
+        self.outdir = args.outdir or self.outdir
+        self.cache = args.cache_dir or self.cache
+        self.chunk_size = args.chunk_size or self.chunk_size
+        if args.fixed_chunk:
+            self.adaptive_chunk = False
+        self.connections = args.connections or self.connections
+        self.host = args.host or self.host
+        if args.hosts is not None:
+            self.hosts = [host.strip() for host in args.hosts.split(",") if host.strip() != ""]
+        if args.stall_timeout is not None:
+            self.stall_timeout = args.stall_timeout
+        if args.limit_rate is not None:
+            self.limit_rate = parse_rate(args.limit_rate)
+        self.host_connections = args.host_connections or self.host_connections
+        self.jobs = args.jobs or self.jobs
+        self.merge_jobs = args.merge_jobs or self.merge_jobs
+        self.small_jobs = args.small_jobs or self.small_jobs
+        self.stream_merge = args.stream_merge or self.stream_merge
+        self.checkout_jobs = args.checkout_jobs or self.checkout_jobs
+        if args.checkout_rate is not None:
+            self.checkout_rate = args.checkout_rate
+        self.incremental = args.incremental or self.incremental
+        if args.retries is not None:
+            self.retries = args.retries
+        if args.retry_delay is not None:
+            self.retry_delay = args.retry_delay
+        if args.meta_max_age is not None:
+            self.meta_max_age = args.meta_max_age
+        self.offline_meta = args.offline_meta or self.offline_meta
+        self.store = args.store or self.store
+        self.store_link = args.store_link or self.store_link
+        self.archive = args.archive or self.archive
+        self.scratch_dir = args.scratch_dir or self.scratch_dir
+        if args.min_free_space is not None:
+            self.min_free_space = parse_rate(args.min_free_space)
+        self.watch_interval = args.watch_interval or self.watch_interval
+        if args.watch_jitter is not None:
+            self.watch_jitter = args.watch_jitter
+        if args.status_port is not None:
+            self.status_port = args.status_port
+        self.order = args.order or self.order
+        if args.meta:
+            self.switches.append("meta")
+            self.switches = list_unique(self.switches)
+        if args.danmaku:
+            self.switches.append("danmaku")
+            self.switches = list_unique(self.switches)
+        if args.cover:
+            self.switches.append("cover")
+            self.switches = list_unique(self.switches)
+        if args.audio_only:
+            self.switches.append("audio")
+            self.switches = list_unique(self.switches)
+            self.switches.remove("video")
+
+    def print_self(self, logger):
+        logger(
+            "Calculated configuration:",
+            f"dest={self.outdir}",
+            f"cookies={self.cookies}",
+            f"cache={self.cache}",
+            f"chunk_size={self.chunk_size}",
+            f"adaptive_chunk={self.adaptive_chunk}",
+            f"connections={self.connections}",
+            f"host={self.host}",
+            f"hosts={','.join(self.hosts)}",
+            f"stall_timeout={self.stall_timeout}",
+            f"limit_rate={self.limit_rate:.0f}",
+            f"host_connections={self.host_connections}",
+            f"jobs={self.jobs}",
+            f"merge_jobs={self.merge_jobs}",
+            f"small_jobs={self.small_jobs}",
+            f"stream_merge={self.stream_merge}",
+            f"checkout_jobs={self.checkout_jobs}",
+            f"checkout_rate={self.checkout_rate}",
+            f"incremental={self.incremental}",
+            f"retries={self.retries}",
+            f"retry_budget={self.retry_budget}",
+            f"retry_delay={self.retry_delay}",
+            f"meta_max_age={self.meta_max_age}",
+            f"offline_meta={self.offline_meta}",
+            f"store={self.store}",
+            f"store_link={self.store_link}",
+            f"archive={self.archive}",
+            f"scratch_dir={self.scratch_dir}",
+            f"min_free_space={self.min_free_space:.0f}",
+            f"watch_interval={self.watch_interval}",
+            f"watch_jitter={self.watch_jitter}",
+            f"status_port={self.status_port}",
+            f"order={self.order}"
+        )
+        logger(f"Switches: {', '.join(self.switches)}")
+        logger(f"Formatters:")
+        for key, value in self.formatter.items():
+            logger(f"  {key}: {value}")
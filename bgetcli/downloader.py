@@ -1,48 +1,159 @@
 import os
-import json
-from typing import Optional
-from bgetlib.models import DownloadProgress, QualityOptions
-import bgetlib.codec as codec
+import threading
+from concurrent.futures import Future
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+from bgetlib.models import QualityOptions
 import bgetlib.utils as utils
 
-from .runtime import Runtime
+from . import codec, mirrors, transfer
+from .runtime import DeduplicatedEntry, ReportEntry, Runtime
+from .retry import describe_error, is_transient
+from .scheduler import chain
+from .store import ContentStore
 from .utils import auto_format, ensure_file_directory_created
 
 
-def show_progress(rt: Runtime, progress: DownloadProgress):
-    progress.bar_format = ("[", 15, "]")
-    progress_text = "{bar} {finished_mb:.2f}/{total_mb:.2f}M {speed_kbps:.2f}K/s avg={avg_speed_kbps:.2f}K/s".format(
-        bar=f"{progress.tag}: {progress.percent:<7}{progress.bar}",
-        finished_mb=progress.finished / 1024 / 1024,
-        total_mb=progress.total / 1024 / 1024,
-        speed_kbps=progress.speed / 1024,
-        avg_speed_kbps=progress.average_speed / 1024,
-    )
-    rt.log_progress(progress_text + (" " * 10))
-    if progress.done:
-        rt.log("")
+# extension of every output, the outputs listed in STORED go through the content store if one is set
+OUTPUTS: Dict[str, str] = dict()
+STORED = ["audio", "video", "cover", "danmaku"]
+# small outputs that go into the section archive instead of files of their own if one is set
+ARCHIVED = ["cover", "danmaku"]
+
+
+def output_path(rt: Runtime, name: str, video: dict, part: Optional[int]) -> str:
+    filename = auto_format(rt.config.formatter[name], video, part, OUTPUTS[name])
+    return os.path.join(rt.config.outdir, filename)
+
+
+def archived(rt: Runtime, name: str) -> bool:
+    return rt.archive is not None and name in ARCHIVED
+
+
+def archive_entry(rt: Runtime, name: str, video: dict, part: Optional[int]) -> str:
+    # the name a danmaku or cover would have as a file, relative to the outdir
+    entry = os.path.relpath(output_path(rt, name, video, part), rt.config.outdir)
+    if name == "cover":
+        entry += cover_extension(video)
+    return entry.replace(os.sep, "/")
+
+
+def store_key(rt: Runtime, name: str, video: dict, part: Optional[int]) -> Optional[str]:
+    if rt.store is None or name not in STORED or archived(rt, name):
+        return None
+    profile = ""
+    if name in ["audio", "video"]:
+        # another account may be offered other qualities of the same part, vip ones get the premium ones
+        profile = ("avc" if rt.args.force_h264 else "auto") + f"-{rt.bapi.account}"
+    return ContentStore.key(video, part, name, profile)
+
+
+def link_stored(rt: Runtime, name: str, video: dict, part: Optional[int]) -> Optional[str]:
+    key = store_key(rt, name, video, part)
+    stored = rt.store.find(key) if key is not None else None
+    if stored is None:
+        return None
+    dest = output_path(rt, name, video, part) + stored[len(rt.store.base(key, OUTPUTS[name])):]
+    ensure_file_directory_created(dest)
+    with rt.metrics.time("write"):
+        rt.store.link(stored, dest)
+    rt.metrics.count("deduplicated")
+    cid = video["pages"][part]["cid"] if part is not None else 0
+    rt.index.record(video["aid"], cid, name, dest)
+    rt.report.deduplicated.append(DeduplicatedEntry(video["aid"], os.path.getsize(stored)))
+    rt.log(f"Linked from store: {name}" + (f" P{part+1}" if part is not None else ""))
+    return dest
+
+
+def link_when_done(rt: Runtime, name: str, video: dict, part: Optional[int], producer: Future) -> Future:
+    # another section is producing the same entry, link to it instead of downloading it again
+    tags = list(rt.log_tags)
+
+    def link(f: Future) -> Optional[str]:
+        rt.log_tags[:] = tags
+        try:
+            if f.cancelled() or f.exception() is not None or f.result() is None:
+                return None
+            return link_stored(rt, name, video, part)
+        except Exception as e:
+            reason = f"{name}" + (f" P{part+1}" if part is not None else "") + f": {describe_error(e)}"
+            rt.fail(ReportEntry(video["aid"], video["title"], reason))
+            rt.log(f"Failed: {reason}")
+            return None
+        finally:
+            rt.log_tags.clear()
+    return chain(producer, link)
 
 
 def downloader(name: str, extension: str = ""):
+    OUTPUTS[name] = extension
+
     def decorator(func):
-        def wrapper(rt: Runtime, video: dict, part: Optional[int] = None):
+        def wrapper(rt: Runtime, video: dict, part: Optional[int] = None, *args):
             rt.log_tags.append(name)
             if part is not None:
                 rt.log_tags.append(f"P{part+1}")
-            filename = auto_format(rt.config.formatter[name], video, part, extension)
-            filepath = os.path.join(rt.config.outdir, filename)
+            filepath = output_path(rt, name, video, part)
             ensure_file_directory_created(filepath)
+            key = store_key(rt, name, video, part)
+            # with a content store the output is written there once and linked into the outdir
+            target = filepath if key is None else rt.store.base(key, extension)
+            ensure_file_directory_created(target)
 
-            result = func(rt, filepath, video, part)
-            rt.log("Saved to {}".format(filename))
-            rt.log_tags.pop()
-            if part is not None:
-                rt.log_tags.pop()
-            return result
+            tags = list(rt.log_tags)
+
+            def complete(saved: str) -> str:
+                rt.log_tags[:] = tags
+                if archived(rt, name):
+                    rt.log("Archived as {}".format(saved.rsplit("#", 1)[1]))
+                    return saved
+                if key is not None:
+                    with rt.metrics.time("write"):
+                        saved = rt.store.link(saved, filepath + saved[len(target):])
+                cid = video["pages"][part]["cid"] if part is not None else 0
+                rt.index.record(video["aid"], cid, name, saved)
+                rt.log("Saved to {}".format(os.path.relpath(saved, rt.config.outdir)))
+                return saved
+
+            def fail(e: Exception) -> None:
+                # a failed item is reported and the batch goes on
+                rt.log_tags[:] = tags
+                reason = f"{name}" + (f" P{part+1}" if part is not None else "") + f": {describe_error(e)}"
+                rt.fail(ReportEntry(video["aid"], video["title"], reason))
+                rt.log(f"Failed: {reason}")
+                return None
+
+            def finish(future: Future) -> Optional[str]:
+                # runs on the post-processing thread, which carries no tags of its own
+                try:
+                    return complete(future.result())
+                except Exception as e:
+                    return fail(e)
+                finally:
+                    rt.log_tags.clear()
+
+            try:
+                saved = func(rt, target, video, part, *args)
+                if isinstance(saved, Future):
+                    return chain(saved, finish)
+                return complete(saved)
+            except Exception as e:
+                return fail(e)
+            finally:
+                rt.log_tags[:] = tags[:-2 if part is not None else -1]
         return wrapper
     return decorator
 
 
+def after(future: Future, session: "StreamSession", saved: str) -> Future:
+    # tracks are released once ffmpeg is done with them
+    def release(f: Future) -> str:
+        session.release(f.exception() is None)
+        f.result()
+        return saved
+    return chain(future, release)
+
+
 def get_av_stream_url(rt: Runtime, filename: str, aid: int, cid: int):
     quality = QualityOptions(
         h265=True,
@@ -66,48 +177,234 @@ def get_av_stream_url(rt: Runtime, filename: str, aid: int, cid: int):
     return stream
 
 
+def scratch_dir(rt: Runtime) -> str:
+    # tracks waiting for the merge, sections sharing a scratch folder or an outdir get a folder each,
+    # they run at the same time and would resume and delete each other's tracks
+    root = rt.config.scratch_dir or os.path.join(rt.config.outdir, ".bget-scratch")
+    return os.path.join(root, rt.section_name or "")
+
+
+class StreamSession:
+    def __init__(self, rt: Runtime, video: dict, part: int, outputs: List[str]):
+        self.rt = rt
+        self.aid: int = video["aid"]
+        self.cid: int = video["pages"][part]["cid"]
+        self.part = part
+        self.outputs = outputs
+        self.users = len(outputs)
+        self.shared = self.users > 1
+        self.failed = False
+        self.stream: Optional[dict] = None
+        self.tracks: Dict[str, str] = dict()
+        # size and range support of every track, probed once for the disk space reservation and the transfer
+        self.probed: Dict[str, Tuple[int, bool]] = dict()
+        self.reservation: Optional[Dict[int, int]] = None
+        # the stream-merge fallback stages the tracks after all
+        self.unpiped = False
+        self.lock = threading.Lock()
+        self.admit_lock = threading.Lock()
+        self.track_locks = {"audio": threading.Lock(), "video": threading.Lock()}
+
+    def stream_url(self) -> dict:
+        with self.lock:
+            if self.stream is None:
+                with self.rt.metrics.time("resolve"):
+                    self.stream = self.rt.retry.call(self.aid, get_av_stream_url, self.rt, "", self.aid, self.cid,
+                                                     logger=self.rt.log)
+            return self.stream
+
+    def tag(self, kind: str) -> str:
+        return f"av{self.aid} P{self.part+1} {kind}"
+
+    def urls(self, kind: str) -> List[str]:
+        url = self.stream_url()[kind]
+        if self.rt.mirrors is None:
+            return [url]
+        # hosts are ranked on the video track, the audio track is too small to tell them apart
+        ranking = self.rt.mirrors.rank(self.stream_url()["video"], self.rt.bapi.session, self.rt.log)
+        return mirrors.alternatives(url, ranking)
+
+    def stalled(self, url: str):
+        # runs on a transfer thread, which carries no log tags
+        self.rt.log(f"av{self.aid} P{self.part+1}: transfer stalled on {urlparse(url).netloc}, switching host.")
+        if self.rt.mirrors is not None:
+            self.rt.mirrors.demote(url)
+
+    def options(self, hosts: bool = True) -> transfer.TransferOptions:
+        config = self.rt.config
+        return transfer.TransferOptions(config.chunk_size, config.connections, config.adaptive_chunk,
+                                        config.stall_timeout, self.rt.limiter, self.rt.progress, self.rt.bapi.session,
+                                        self.rt.bapi.connections if hosts else None, self.stalled)
+
+    def probe(self, kind: str) -> Tuple[int, bool]:
+        with self.track_locks[kind]:
+            if kind not in self.probed:
+                self.probed[kind] = self.rt.retry.call(self.aid, transfer.probe, self.urls(kind), self.options(),
+                                                       logger=self.rt.log)
+            return self.probed[kind]
+
+    def staged(self) -> bool:
+        # only a video output of its own is piped into ffmpeg with stream-merge
+        if self.unpiped or self.outputs != ["video"]:
+            return True
+        return not (self.rt.config.stream_merge and codec.PIPES_SUPPORTED)
+
+    def unpipe(self, filename: str):
+        # the piped reservation has no room for the tracks in the scratch folder, it is given back and
+        # taken again with them, a holder never waits with space in hand
+        with self.admit_lock:
+            self.unpiped = True
+            if self.reservation is not None:
+                self.rt.space.release(self.reservation)
+                self.reservation = None
+        self.admit(filename)
+
+    def admit(self, filename: str):
+        # the first output of the part reserves the tracks and every output before any byte is received
+        with self.admit_lock:
+            if self.reservation is not None:
+                return
+            kinds = ["audio"] if self.outputs == ["audio"] else ["audio", "video"]
+            sizes = {kind: self.probe(kind)[0] for kind in kinds}
+            # a merged file is about as large as its tracks
+            outputs = sum(sizes["audio"] + (sizes["video"] if output == "video" else 0) for output in self.outputs)
+            needs = {os.path.dirname(os.path.abspath(filename)): outputs}
+            if self.staged():
+                scratch = os.path.abspath(scratch_dir(self.rt))
+                needs[scratch] = needs.get(scratch, 0) + sum(sizes.values())
+            self.reservation = self.rt.space.reserve(needs, self.rt.log)
+
+    def track(self, kind: str) -> str:
+        with self.track_locks[kind]:
+            if kind not in self.tracks:
+                path = os.path.join(scratch_dir(self.rt), f".av{self.aid}-{self.cid}.{kind}.m4s")
+                ensure_file_directory_created(path)
+                # a retried fetch resumes from the bytes already on disk
+                with self.rt.metrics.time("transfer"):
+                    size = self.rt.retry.call(self.aid, transfer.fetch, self.urls(kind), path, self.tag(kind),
+                                              self.options(), self.probed.get(kind), logger=self.rt.log)
+                self.rt.metrics.add_bytes("transfer", size)
+                self.tracks[kind] = path
+            return self.tracks[kind]
+
+    def source(self, kind: str) -> Union[str, codec.StreamWriter]:
+        # a track needed by another output of the part is staged on disk, otherwise it is piped to ffmpeg
+        if self.shared or kind in self.tracks:
+            return self.track(kind)
+
+        def write(output: BinaryIO):
+            # the connection slot is taken by the merge, see download_video
+            with self.rt.metrics.time("transfer"):
+                size = transfer.stream(self.urls(kind), output, self.tag(kind), self.options(hosts=False))
+            self.rt.metrics.add_bytes("transfer", size)
+        return write
+
+    def release(self, success: bool):
+        # the downloaded tracks are shared by the audio and video outputs of the part,
+        # they are kept with their sidecars for the next run if any output failed
+        with self.lock:
+            self.users -= 1
+            self.failed = self.failed or not success
+            if self.users > 0:
+                return
+            if self.reservation is not None:
+                self.rt.space.release(self.reservation)
+            if self.failed:
+                return
+        for path in self.tracks.values():
+            transfer.discard(path)
+
+
 @downloader("audio")
-def download_audio(rt: Runtime, filename: str, video: dict, part: int):
-    stream = get_av_stream_url(rt, filename, video["aid"], video["pages"][part]["cid"])
-    audio_stream = rt.bapi.get_stream(stream["audio"], "audio", rt.config.chunk_size,
-                                      callback=lambda p: show_progress(rt, p))
-    extension = "aac"
-    if stream["quality"].dolby_audio:
-        extension = "ac3"
-    if stream["quality"].flac_audio:
-        extension = "flac"
-    return codec.extract_audio(audio_stream, filename + extension, stream["quality"])
+def download_audio(rt: Runtime, filename: str, video: dict, part: int, session: StreamSession):
+    try:
+        session.admit(filename)
+        extension = codec.audio_extension(session.stream_url()["quality"])
+        audio_track = session.track("audio")
+    except BaseException:
+        session.release(False)
+        raise
+    extracted = rt.scheduler.postprocess(codec.extract_audio, audio_track, filename + extension)
+    return after(extracted, session, filename + extension)
 
 
 @downloader("video", extension="mp4")
-def download_video(rt: Runtime, filename: str, video: dict, part: int):
-    stream = get_av_stream_url(rt, filename, video["aid"], video["pages"][part]["cid"])
-    audio_stream = rt.bapi.get_stream(stream["audio"], "audio", rt.config.chunk_size,
-                                      callback=lambda p: show_progress(rt, p))
-    video_stream = rt.bapi.get_stream(stream["video"], "video", rt.config.chunk_size,
-                                      callback=lambda p: show_progress(rt, p))
-    return codec.merge(audio_stream, video_stream, filename)
+def download_video(rt: Runtime, filename: str, video: dict, part: int, session: StreamSession):
+    if rt.config.stream_merge and codec.PIPES_SUPPORTED:
+        # muxing runs while the tracks arrive, it does not go through the post-processing queue
+        try:
+            session.admit(filename)
+            sources = [session.source("audio"), session.source("video")]
+            # both piped streams are open at once, their host connections are held together
+            piped = [session.urls(kind)[0] for kind, source in zip(["audio", "video"], sources)
+                     if not isinstance(source, str)]
+            with rt.bapi.connections.hold(*piped), rt.metrics.time("merge"):
+                codec.merge_streams(*sources, filename)
+        except Exception as e:
+            if not is_transient(e):
+                session.release(False)
+                raise
+            # bytes already piped into ffmpeg can not be sent again, the tracks are fetched to disk with retries
+            rt.log(f"Piped transfer failed, downloading the tracks first: {describe_error(e)}")
+        except BaseException:
+            session.release(False)
+            raise
+        else:
+            session.release(True)
+            return filename
+        try:
+            session.unpipe(filename)
+        except BaseException:
+            session.release(False)
+            raise
+    try:
+        session.admit(filename)
+        audio_track = session.track("audio")
+        video_track = session.track("video")
+    except BaseException:
+        session.release(False)
+        raise
+    merged = rt.scheduler.postprocess(codec.merge, audio_track, video_track, filename)
+    return after(merged, session, filename)
+
+
+def save_small(rt: Runtime, name: str, filename: str, content: bytes, compress: bool = True) -> str:
+    with rt.metrics.time("write"):
+        rt.metrics.add_bytes("write", len(content))
+        if archived(rt, name):
+            entry = os.path.relpath(filename, rt.config.outdir).replace(os.sep, "/")
+            return rt.archive.add(entry, content, compress)
+        # written under a temporary name, a crash never leaves a truncated file under its name
+        with open(filename + ".tmp", "wb+") as f:
+            f.write(content)
+        os.replace(filename + ".tmp", filename)
+        return filename
+
+
+def cover_extension(video: dict) -> str:
+    return os.path.splitext(urlparse(video["pic"]).path)[1][1:]
 
 
 @downloader("danmaku", extension="xml")
 def download_danmaku(rt: Runtime, filename: str, video: dict, part: int):
-    content = rt.bapi.get_live_danmaku(video["pages"][part]["cid"])
-    with open(filename, "wb+") as f:
-        f.write(content)
+    content = rt.retry.call(video["aid"], rt.bapi.get_live_danmaku, video["pages"][part]["cid"], logger=rt.log)
+    return save_small(rt, "danmaku", filename, content)
 
 
 @downloader("cover")
 def download_cover(rt: Runtime, filename: str, video: dict, _: Optional[int]):
-    basename, image = rt.bapi.get_cover_picture(video["aid"])
-    extension = os.path.splitext(basename)[1]
-    if extension.startswith("."):
-        extension = extension[1:]
-    filename = filename + extension
-    with open(filename, "wb+") as f:
-        f.write(image)
+    # the picture url is in the video info already, no need to ask the api for it again
+    image = rt.retry.call(video["aid"], rt.bapi.get_cover, video["pic"], logger=rt.log)
+    # pictures are compressed already
+    return save_small(rt, "cover", filename + cover_extension(video), image, compress=False)
 
 
 @downloader("meta", extension="json")
 def download_meta(rt: Runtime, filename: str, video: dict, _: Optional[int]):
-    with open(filename, "w+", encoding="utf-8") as f:
-        f.write(json.dumps(video, ensure_ascii=False, indent=4))
+    text = rt.meta.text(video)
+    with rt.metrics.time("write"):
+        rt.metrics.add_bytes("write", len(text))
+        with open(filename + ".tmp", "w+", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(filename + ".tmp", filename)
+    return filename
@@ -0,0 +1,109 @@
+import os
+import json
+from typing import Dict, List, Optional, Set
+
+from .runtime import ReportEntry, Runtime, SectionHead
+
+
+class FavoriteSync:
+    def __init__(self, runtime: Runtime, favorite_id: int):
+        self.runtime = runtime
+        self.favorite_id = favorite_id
+        self.path = os.path.join(runtime.config.cache, "favorites", f"{favorite_id}.json")
+        self.items: List[dict] = list()
+        self.high_water: Dict[str, int] = dict()
+        self.listed_high_water: Optional[int] = None
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            self.items = cache.get("items", [])
+            self.high_water = cache.get("high_water", {})
+
+    @staticmethod
+    def compact(media: dict, page: int) -> dict:
+        return {"id": media["id"], "title": media["title"], "fav_time": media["fav_time"], "page": page}
+
+    def page(self, page: int) -> List[dict]:
+        return self.runtime.retry.call(("fav", self.favorite_id, page), self.runtime.bapi.get_favorites,
+                                       self.favorite_id, page, logger=self.runtime.log)
+
+    def fetch_ids(self) -> Optional[Set[int]]:
+        # noinspection PyBroadException
+        try:
+            path = f"/x/v3/fav/resource/ids?media_id={self.favorite_id}&platform=web"
+            return set(media["id"] for media in self.runtime.bapi._interface_request(path)["data"] or [])
+        except Exception:
+            return None
+
+    def rescan(self) -> List[dict]:
+        items = list()
+        page = 1
+        while True:
+            medias = self.page(page)
+            if len(medias) == 0:
+                return items
+            items += [FavoriteSync.compact(media, page) for media in medias]
+            page += 1
+
+    def refresh(self) -> List[dict]:
+        # the folder is listed newest first, stop at the first item already in the cache
+        known = set((item["id"], item["fav_time"]) for item in self.items)
+        added = list()
+        page = 1
+        reached_known = False
+        while not reached_known:
+            medias = self.page(page)
+            if len(medias) == 0:
+                break
+            for media in medias:
+                if (media["id"], media["fav_time"]) in known:
+                    reached_known = True
+                    break
+                added.append(FavoriteSync.compact(media, page))
+            page += 1
+        added_ids = set(item["id"] for item in added)
+        items = added + [item for item in self.items if item["id"] not in added_ids]
+        self.runtime.log(f"Favorite listing: {len(added)} new items in {page - 1} pages, {len(items)} cached.")
+
+        ids = self.fetch_ids()
+        if ids is None:
+            self.runtime.log("Can not fetch folder ids, removal detection skipped.")
+        elif len(ids - set(item["id"] for item in items)) > 0:
+            self.runtime.log("Cached listing is out of date, rescanning the whole folder.")
+            items = self.rescan()
+        else:
+            removed = [item for item in items if item["id"] not in ids]
+            for item in removed:
+                self.runtime.log(f"Removed from folder: av{item['id']}: {item['title']:20}")
+            self.runtime.report.removed += [ReportEntry.of(item) for item in removed]
+            items = [item for item in items if item["id"] in ids]
+
+        self.items = items
+        self.listed_high_water = max([item["fav_time"] for item in items], default=None)
+        self.save()
+        return list(self.items)
+
+    def since(self, section_head: SectionHead) -> List[dict]:
+        high_water = self.high_water.get(self.runtime.section_name)
+        if high_water is None:
+            # first incremental run of the section, continue from the legacy head timestamp
+            return [item for item in self.items if item["fav_time"] >= section_head.read()]
+        self.runtime.log(f"Reading high-water mark: {high_water}")
+        return [item for item in self.items if item["fav_time"] > high_water]
+
+    def commit(self):
+        if self.runtime.section_name is None or self.listed_high_water is None:
+            return
+        self.runtime.log(f"Writing high-water mark: {self.listed_high_water}")
+        if os.path.exists(self.path):
+            # other sections of the batch may sync the same folder
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.high_water = json.load(f).get("high_water", {})
+        self.high_water[self.runtime.section_name] = self.listed_high_water
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"items": self.items, "high_water": self.high_water}, ensure_ascii=False))
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,55 @@
+import os
+import json
+import shutil
+import subprocess
+from typing import Optional
+
+CACHE_FILENAME = "ffmpeg.json"
+# merges run in spawned worker processes, they find the located binary through the environment
+PATH_ENVIRON = "BGET_FFMPEG"
+
+
+def probe(path: str) -> dict:
+    stat = os.stat(path)
+    output = subprocess.run([path, "-hide_banner", "-version"], capture_output=True).stdout.decode("utf-8", "replace")
+    lines = output.splitlines()
+    return {
+        "path": path,
+        "size": stat.st_size,
+        "mtime": int(stat.st_mtime),
+        "version": lines[0].split(" Copyright")[0].strip() if len(lines) > 0 else "",
+        "configuration": next((line.split(":", 1)[1].strip() for line in lines if line.startswith("configuration:")), ""),
+    }
+
+
+def locate(cache: str) -> Optional[dict]:
+    # the binary found last time is reused while it and the PATH it was found on are unchanged,
+    # so the PATH walk and the version query of ffmpeg are skipped on most runs
+    cache_path = os.path.join(cache, CACHE_FILENAME)
+    info = None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        stat = os.stat(cached["path"])
+        if cached["search"] == os.environ.get("PATH", "") and stat.st_size == cached["size"] and int(stat.st_mtime) == cached["mtime"]:
+            info = cached
+    except (OSError, ValueError, KeyError):
+        pass
+    if info is None:
+        path = shutil.which("ffmpeg")
+        if path is None or path == "":
+            return None
+        info = probe(path)
+        info["search"] = os.environ.get("PATH", "")
+        try:
+            os.makedirs(cache, exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as f:
+                json.dump(info, f, indent=4)
+        except OSError:
+            pass
+    os.environ[PATH_ENVIRON] = info["path"]
+    return info
+
+
+def executable() -> str:
+    return os.environ.get(PATH_ENVIRON) or "ffmpeg"
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Tuple
+
+INDEX_FILENAME = ".bget-index.sqlite3"
+_opened: Dict[str, "CompletionIndex"] = dict()
+_opened_lock = threading.Lock()
+
+
+class CompletionIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS completed ("
+                        "aid INTEGER, cid INTEGER, switch TEXT, path TEXT, size INTEGER, mtime INTEGER, "
+                        "PRIMARY KEY (aid, cid, switch))")
+        self.db.commit()
+        # the whole index is kept in memory, so a lookup costs one dict access and one stat
+        self.entries: Dict[Tuple[int, int, str], Tuple[str, int, int]] = dict()
+        for aid, cid, switch, path, size, mtime in self.db.execute("SELECT * FROM completed"):
+            self.entries[(aid, cid, switch)] = (path, size, mtime)
+
+    @staticmethod
+    def open(outdir: str) -> "CompletionIndex":
+        # sections sharing an outdir share one index
+        path = os.path.abspath(os.path.join(outdir, INDEX_FILENAME))
+        with _opened_lock:
+            if path not in _opened:
+                os.makedirs(outdir, exist_ok=True)
+                _opened[path] = CompletionIndex(path)
+            return _opened[path]
+
+    def done(self, aid: int, cid: int, switch: str, output: str) -> bool:
+        # output is the path the formatter names now, a recorded file under another name is not it,
+        # the extension of audio and covers is known after the download only and follows the name
+        entry = self.entries.get((aid, cid, switch))
+        if entry is None:
+            return False
+        path, size, mtime = entry
+        output = os.path.abspath(output)
+        if not path.startswith(output) or not (path == output or path[len(output):].isalnum()):
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return stat.st_size == size and int(stat.st_mtime) == mtime
+
+    def record(self, aid: int, cid: int, switch: str, path: str):
+        stat = os.stat(path)
+        entry = (os.path.abspath(path), stat.st_size, int(stat.st_mtime))
+        with self.lock:
+            self.entries[(aid, cid, switch)] = entry
+            self.db.execute("INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?, ?)", (aid, cid, switch, *entry))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
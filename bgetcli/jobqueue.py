@@ -0,0 +1,57 @@
+import os
+import json
+import threading
+from typing import Dict, List
+
+QUEUE_FILENAME = "queue.json"
+# runs an item may fail in before it is dropped from the queue
+MAX_ATTEMPTS = 3
+
+
+class JobQueue:
+    # items listed but not downloaded yet, kept on disk so the next run picks them up again,
+    # the section head moves on as soon as the items are queued
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.items: Dict[str, List[dict]] = dict()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.items = json.load(f)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.items, f, ensure_ascii=False)
+        os.replace(self.path + ".tmp", self.path)
+
+    def add(self, section: str, tasks: List[dict]):
+        with self.lock:
+            queued = self.items.setdefault(section, [])
+            known = set(task["id"] for task in queued)
+            for task in tasks:
+                if task["id"] not in known:
+                    known.add(task["id"])
+                    queued.append(dict(task, attempts=0))
+            self.save()
+
+    def pending(self, section: str) -> List[dict]:
+        with self.lock:
+            return list(self.items.get(section, []))
+
+    def finish(self, section: str, failed: set) -> List[dict]:
+        # finished items leave the queue, failed ones stay for the next run until they run out of attempts
+        with self.lock:
+            remains, dropped = list(), list()
+            for task in self.items.get(section, []):
+                if task["id"] not in failed:
+                    continue
+                task["attempts"] = task.get("attempts", 0) + 1
+                (remains if task["attempts"] < MAX_ATTEMPTS else dropped).append(task)
+            self.items[section] = remains
+            self.save()
+            return dropped
+
+    def depth(self) -> Dict[str, int]:
+        with self.lock:
+            return {section: len(tasks) for section, tasks in self.items.items()}
@@ -0,0 +1,194 @@
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 0, parent: Optional["TokenBucket"] = None):
+        self.rate = float(rate or 0)
+        self.parent = parent
+        self.burst = float(burst or max(self.rate, 1))
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    @property
+    def effective_rate(self) -> float:
+        rates = [bucket.rate for bucket in (self, self.parent) if bucket is not None and not bucket.unlimited]
+        return min(rates, default=0)
+
+    def acquire(self, amount: float = 1):
+        # a section bucket also draws from the bucket shared by the whole batch
+        if self.parent is not None:
+            self.parent.acquire(amount)
+        if self.unlimited:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                # requests larger than the bucket are let through once it is full
+                if self.tokens >= min(amount, self.burst):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.burst) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostConnections:
+    def __init__(self, per_host: int = 0):
+        self.per_host = per_host
+        self.active: Dict[str, int] = dict()
+        self.condition = threading.Condition()
+
+    def fits(self, hosts: Counter) -> bool:
+        # a holder asking for more than the cap is let through once the host is idle
+        return all(self.active.get(host, 0) + count <= max(self.per_host, count) for host, count in hosts.items())
+
+    @contextmanager
+    def hold(self, *urls: str):
+        if self.per_host <= 0 or len(urls) == 0:
+            yield
+            return
+        # every slot is taken at once, a holder never waits with slots in hand
+        hosts = Counter(urlparse(url).hostname for url in urls)
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(hosts))
+            for host, count in hosts.items():
+                self.active[host] = self.active.get(host, 0) + count
+        try:
+            yield
+        finally:
+            with self.condition:
+                for host, count in hosts.items():
+                    self.active[host] -= count
+                self.condition.notify_all()
+
+
+class DiskSpaceError(IOError):
+    pass
+
+
+def existing(path: str) -> str:
+    # the output folder may not exist yet, its nearest existing parent is on the same filesystem
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+class DiskSpace:
+    # a download reserves what it is going to write before it starts, and waits while the reservations of
+    # the running ones would take the filesystem below min_free, the bytes they wrote so far are counted twice
+    # until they finish, which errs on the safe side
+    POLL_INTERVAL = 5.0
+    # how long a part that does not fit on its own waits for space freed outside of bget
+    TIMEOUT = 600.0
+
+    def __init__(self, min_free: float = 0, timeout: float = TIMEOUT):
+        self.min_free = min_free
+        self.timeout = timeout
+        # bytes reserved on every filesystem, by device number
+        self.reserved: Dict[int, int] = dict()
+        self.condition = threading.Condition()
+
+    def shortage(self, needs: Dict[int, Tuple[str, int]]) -> Optional[Tuple[int, str, int, int]]:
+        for device, (path, size) in needs.items():
+            free = shutil.disk_usage(path).free - self.reserved.get(device, 0)
+            if free - size < self.min_free:
+                return device, path, size, free
+        return None
+
+    def reserve(self, sizes: Dict[str, int], on_wait: Optional[Callable[[str], None]] = None) -> Dict[int, int]:
+        # every filesystem is reserved at once, a holder never waits with space in hand
+        needs: Dict[int, Tuple[str, int]] = dict()
+        for path, size in sizes.items():
+            path = existing(path)
+            device = os.stat(path).st_dev
+            needs[device] = (path, needs.get(device, (path, 0))[1] + size)
+        waiting = False
+        deadline: Optional[float] = None
+        with self.condition:
+            while True:
+                short = self.shortage(needs)
+                if short is None:
+                    break
+                device, path, size, free = short
+                message = (f"{size / 1024 / 1024:.2f}M needed on {path}, {free / 1024 / 1024:.2f}M free "
+                           f"and {self.min_free / 1024 / 1024:.2f}M kept free")
+                if self.reserved.get(device, 0) == 0:
+                    # nothing running gives space back, only files removed outside of bget do, so the wait
+                    # is bounded and a smaller item may still fit after it
+                    if deadline is None:
+                        deadline = time.monotonic() + self.timeout
+                    elif time.monotonic() >= deadline:
+                        raise DiskSpaceError(f"not enough disk space: {message}")
+                else:
+                    deadline = None
+                if on_wait is not None and not waiting:
+                    on_wait(f"Waiting for disk space: {message}")
+                waiting = True
+                # files removed by others count as well, so the disk is checked again now and then
+                interval = self.POLL_INTERVAL
+                if deadline is not None:
+                    interval = max(0.0, min(interval, deadline - time.monotonic()))
+                self.condition.wait(interval)
+            for device, (_, size) in needs.items():
+                self.reserved[device] = self.reserved.get(device, 0) + size
+        return {device: size for device, (_, size) in needs.items()}
+
+    def release(self, reservation: Dict[int, int]):
+        with self.condition:
+            for device, size in reservation.items():
+                self.reserved[device] -= size
+            self.condition.notify_all()
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = 5, cooldown: float = 30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.rejections = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    @property
+    def remains(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    def before(self):
+        # while open every caller waits, instead of adding to the rejections
+        while True:
+            with self.lock:
+                wait = self.open_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def record(self, rejected: bool):
+        with self.lock:
+            if not rejected:
+                self.rejections = 0
+                self.trips = 0
+                return
+            self.rejections += 1
+            if self.rejections >= self.threshold and not self.open:
+                # every trip in a row doubles the pause, up to eight times the cooldown
+                self.open_until = time.monotonic() + self.cooldown * min(2 ** self.trips, 8)
+                self.rejections = 0
+                self.trips += 1
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict
+
+CACHE_FILENAME = "meta.sqlite3"
+# bodies kept in memory, enough for the videos between checkout and the meta output with room for
+# sections listing the same videos close together
+RECENT_BODIES = 256
+
+
+class MetaCacheMiss(LookupError):
+    pass
+
+
+class MetaCache:
+    def __init__(self, cache: str, max_age: float, size_limit: int, offline: bool = False):
+        os.makedirs(cache, exist_ok=True)
+        self.path = os.path.join(cache, CACHE_FILENAME)
+        self.max_age = max_age
+        self.size_limit = size_limit
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS videos ("
+                        "aid INTEGER PRIMARY KEY, fetched_at REAL, accessed_at REAL, body TEXT)")
+        self.db.commit()
+        # serialised info of the videos checked out last, sections listing the same video share one request,
+        # older ones are read from the database again, or fetched when it has no fresh copy
+        self.bodies: "OrderedDict[int, str]" = OrderedDict()
+        self.inflight: Dict[int, Future] = dict()
+        self.hits = 0
+        self.fetched = 0
+
+    @staticmethod
+    def serialize(video: dict) -> str:
+        # the same text is written as the meta file, so it is never serialised twice
+        return json.dumps(video, ensure_ascii=False, indent=4)
+
+    def load(self, aid: int):
+        with self.lock:
+            row = self.db.execute("SELECT fetched_at, body FROM videos WHERE aid = ?", (aid,)).fetchone()
+            if row is None:
+                return None
+            fetched_at, body = row
+            if not self.offline and (self.max_age <= 0 or time.time() - fetched_at > self.max_age):
+                return None
+            self.db.execute("UPDATE videos SET accessed_at = ? WHERE aid = ?", (time.time(), aid))
+            return body
+
+    def store(self, aid: int, body: str):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?)", (aid, now, now, body))
+            self.db.commit()
+
+    def get(self, aid: int, fetch: Callable[[], dict]) -> dict:
+        with self.lock:
+            if aid in self.bodies:
+                self.bodies.move_to_end(aid)
+                return json.loads(self.bodies[aid])
+            future = self.inflight.get(aid)
+            owner = future is None
+            if owner:
+                future = self.inflight[aid] = Future()
+        if not owner:
+            return json.loads(future.result())
+        try:
+            body = self.load(aid)
+            if body is not None:
+                self.hits += 1
+            elif self.offline:
+                raise MetaCacheMiss(f"av{aid} is not in the metadata cache")
+            else:
+                video = fetch()
+                body = MetaCache.serialize(video)
+                self.fetched += 1
+                self.store(aid, body)
+            future.set_result(body)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(aid, None)
+                if future.exception() is None:
+                    self.bodies[aid] = future.result()
+                    if len(self.bodies) > RECENT_BODIES:
+                        self.bodies.popitem(last=False)
+        return json.loads(body)
+
+    def text(self, video: dict) -> str:
+        with self.lock:
+            body = self.bodies.get(video["aid"])
+        return body or MetaCache.serialize(video)
+
+    def reset(self):
+        # the bodies are shared by the sections of one run, a long running process drops them between runs
+        with self.lock:
+            self.bodies.clear()
+
+    def evict(self):
+        # least recently used videos go first once the cache is over its size
+        with self.lock:
+            total = self.db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM videos").fetchone()[0]
+            if total <= self.size_limit:
+                return
+            evicted = list()
+            for aid, size in self.db.execute("SELECT aid, LENGTH(body) FROM videos ORDER BY accessed_at"):
+                if total <= self.size_limit:
+                    break
+                evicted.append((aid,))
+                total -= size
+            self.db.executemany("DELETE FROM videos WHERE aid = ?", evicted)
+
+    def flush(self):
+        self.evict()
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,170 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+STAGES = ["listing", "checkout", "resolve", "transfer", "merge", "write"]
+# upper bounds in seconds, from a small api request to a long merge
+BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0]
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the quantile, the largest value for the last bucket
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return 0.0
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        self.bytes: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.failures: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.counters: Dict[str, int] = dict()
+        # current and highest depth of every queue
+        self.queues: Dict[str, List[int]] = dict()
+        # wall time with at least one timed operation of the stage running, concurrent ones counted once
+        self.active: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.busy: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        self.busy_since: Dict[str, float] = dict()
+
+    def observe(self, stage: str, seconds: float, size: int = 0, failed: bool = False):
+        with self.lock:
+            self.histograms[stage].observe(seconds)
+            self.bytes[stage] += size
+            if failed:
+                self.failures[stage] += 1
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        started_at = time.monotonic()
+        with self.lock:
+            if self.active[stage] == 0:
+                self.busy_since[stage] = started_at
+            self.active[stage] += 1
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            finished_at = time.monotonic()
+            with self.lock:
+                self.active[stage] -= 1
+                if self.active[stage] == 0:
+                    self.busy[stage] += finished_at - self.busy_since.pop(stage)
+            self.observe(stage, finished_at - started_at, failed=failed)
+
+    def transferred(self) -> Tuple[int, float]:
+        # bytes received and the wall time spent receiving them, in flight transfers included
+        with self.lock:
+            busy = self.busy["transfer"]
+            if self.active["transfer"] > 0:
+                busy += time.monotonic() - self.busy_since["transfer"]
+            return self.bytes["transfer"], busy
+
+    def add_bytes(self, stage: str, size: int):
+        with self.lock:
+            self.bytes[stage] += size
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def queue(self, name: str, change: int):
+        with self.lock:
+            depth = self.queues.setdefault(name, [0, 0])
+            depth[0] += change
+            depth[1] = max(depth[1], depth[0])
+
+    def summary(self) -> dict:
+        with self.lock:
+            stages = dict()
+            for stage in STAGES:
+                histogram = self.histograms[stage]
+                stages[stage] = {
+                    "count": histogram.count,
+                    "failed": self.failures[stage],
+                    "seconds": round(histogram.sum, 3),
+                    "mean": round(histogram.sum / histogram.count, 3) if histogram.count > 0 else 0.0,
+                    "p50": histogram.quantile(0.5),
+                    "p90": histogram.quantile(0.9),
+                    "p99": histogram.quantile(0.99),
+                    "max": round(histogram.max, 3),
+                    "bytes": self.bytes[stage],
+                    # bytes per second of stage time, concurrent jobs make it a per job figure
+                    "throughput": round(self.bytes[stage] / histogram.sum) if histogram.sum > 0 else 0,
+                    "buckets": dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram.counts)),
+                }
+            return {
+                "started_at": self.started_at,
+                "elapsed": round(time.time() - self.started_at, 3),
+                "stages": stages,
+                "counters": dict(self.counters),
+                "queues": {name: {"depth": depth[0], "max": depth[1]} for name, depth in self.queues.items()},
+            }
+
+    def write_json(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=4)
+
+    def write_prometheus(self, path: str):
+        # text exposition format, for the node exporter textfile collector and the like
+        summary = self.summary()
+        lines: List[str] = list()
+
+        def metric(name: str, kind: str, helps: str, samples: List[Tuple[str, float]]):
+            lines.append(f"# HELP bget_{name} {helps}")
+            lines.append(f"# TYPE bget_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"bget_{name}{labels} {value}")
+
+        with self.lock:
+            buckets = list()
+            for stage in STAGES:
+                histogram = self.histograms[stage]
+                seen = 0
+                for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], histogram.counts):
+                    seen += count
+                    buckets.append((f'_bucket{{stage="{stage}",le="{bound}"}}', seen))
+                buckets.append((f'_sum{{stage="{stage}"}}', round(histogram.sum, 6)))
+                buckets.append((f'_count{{stage="{stage}"}}', histogram.count))
+        lines.append("# HELP bget_stage_seconds time spent in every pipeline stage")
+        lines.append("# TYPE bget_stage_seconds histogram")
+        lines += [f"bget_stage_seconds{labels} {value}" for labels, value in buckets]
+        stages = summary["stages"]
+        metric("stage_failures_total", "counter", "failed operations of every pipeline stage",
+               [(f'{{stage="{stage}"}}', stages[stage]["failed"]) for stage in STAGES])
+        metric("stage_bytes_total", "counter", "bytes handled by every pipeline stage",
+               [(f'{{stage="{stage}"}}', stages[stage]["bytes"]) for stage in STAGES])
+        metric("events_total", "counter", "events such as retries and deduplicated files",
+               [(f'{{event="{name}"}}', value) for name, value in sorted(summary["counters"].items())])
+        metric("queue_depth_max", "gauge", "highest depth of every work queue",
+               [(f'{{queue="{name}"}}', queue["max"]) for name, queue in sorted(summary["queues"].items())])
+        metric("run_seconds", "gauge", "duration of the run", [("", summary["elapsed"])])
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import threading
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import requests
+from bgetlib.utils import replace_host
+
+from .transfer import HEADERS, TIMEOUT
+
+PROBE_SIZE = 256 * 1024
+RANKING_FILENAME = "hosts.json"
+
+
+class HostRanking:
+    def __init__(self, cache: str, hosts: List[str], ttl: float):
+        self.path = os.path.join(cache, RANKING_FILENAME)
+        self.hosts = hosts
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results: Optional[List[dict]] = None
+        self.probed_at = 0.0
+        # a missing, truncated or foreign cache file is probed again, like the ffmpeg cache
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            fresh = time.time() - cache["probed_at"] < self.ttl
+            if fresh and sorted(result["host"] for result in cache["results"]) == sorted(self.hosts):
+                self.results = list(cache["results"])
+                self.probed_at = float(cache["probed_at"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def probe_host(url: str, host: str, session: Optional[requests.Session] = None) -> dict:
+        # a small ranged read of a real stream, timed to the first byte and to the end
+        headers = dict(HEADERS, Range=f"bytes=0-{PROBE_SIZE - 1}")
+        started_at = time.perf_counter()
+        try:
+            with (session or requests).get(replace_host(url, host), headers=headers, stream=True, timeout=TIMEOUT) as r:
+                r.raise_for_status()
+                received = 0
+                latency = None
+                for chunk in r.iter_content(chunk_size=16 * 1024):
+                    if latency is None:
+                        latency = time.perf_counter() - started_at
+                    received += len(chunk)
+            elapsed = time.perf_counter() - started_at
+        except (requests.RequestException, OSError) as e:
+            return {"host": host, "latency": None, "throughput": 0, "error": str(e) or type(e).__name__}
+        return {"host": host, "latency": latency or elapsed, "throughput": received / max(elapsed, 1e-6)}
+
+    @staticmethod
+    def score(result: dict) -> tuple:
+        # unreachable hosts go last, then the fastest first, latency breaks near ties
+        if result["latency"] is None:
+            return 1, 0, 0
+        return 0, -round(result["throughput"] / (256 * 1024)), result["latency"]
+
+    def rank(self, url: str, session: Optional[requests.Session] = None, logger=None) -> List[str]:
+        with self.lock:
+            if self.results is None:
+                self.results = sorted([HostRanking.probe_host(url, host, session) for host in self.hosts],
+                                      key=HostRanking.score)
+                self.probed_at = time.time()
+                if logger is not None:
+                    for result in self.results:
+                        logger("Probed host {host}: {state}".format(host=result["host"], state=(
+                            "{:.0f}ms {:.2f}K/s".format(result["latency"] * 1000, result["throughput"] / 1024)
+                            if result["latency"] is not None else result["error"])))
+                self.save()
+            return [result["host"] for result in self.results]
+
+    def demote(self, url: str):
+        # a host that stalled a transfer is tried last until the ranking expires
+        host = urlparse(url).netloc
+        with self.lock:
+            if self.results is None:
+                return
+            demoted = [result for result in self.results if result["host"] == host]
+            if len(demoted) == 0 or self.results[-1]["host"] == host:
+                return
+            self.results = [result for result in self.results if result["host"] != host] + demoted
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"probed_at": self.probed_at, "results": self.results}, ensure_ascii=False))
+        os.replace(self.path + ".tmp", self.path)
+
+
+def alternatives(url: str, hosts: List[str]) -> List[str]:
+    # the url handed out by the api stays as the last resort
+    urls = [replace_host(url, host) for host in hosts]
+    return urls + ([url] if url not in urls else [])
+
@@ -0,0 +1,208 @@
+import os
+import json
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
+
+if TYPE_CHECKING:
+    from .runtime import Runtime
+
+# favourite keeps the folder order and streams, the others wait for the whole checkout to sort it
+ORDERS = ["favourite", "smallest", "newest", "uploader"]
+HISTORY_FILENAME = "throughput.json"
+HISTORY_SIZE = 20
+# a run receiving less than this says more about latency than about the link
+MIN_SAMPLE_SIZE = 16 * 1024 * 1024
+
+
+class Throughput:
+    # bytes received and seconds spent receiving them in the last runs, the planner turns them into an ETA
+    def __init__(self, cache: str):
+        self.path = os.path.join(cache, HISTORY_FILENAME)
+        self.samples: List[List[float]] = list()
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.samples = json.load(f)
+
+    def record(self, size: int, seconds: float):
+        if size < MIN_SAMPLE_SIZE or seconds <= 0:
+            return
+        self.samples = (self.samples + [[size, round(seconds, 3)]])[-HISTORY_SIZE:]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.samples, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def rate(self) -> Optional[float]:
+        seconds = sum(sample[1] for sample in self.samples)
+        if seconds <= 0:
+            return None
+        return sum(sample[0] for sample in self.samples) / seconds
+
+
+def order_videos(runtime: "Runtime", videos: Iterator[dict]) -> Iterator[dict]:
+    policy = runtime.config.order
+    if policy == "favourite":
+        yield from videos
+        return
+    videos = list(videos)
+    if policy == "smallest":
+        # the duration stands in for the size, it is in the video info while a size costs a request per track,
+        # videos without one go last
+        videos.sort(key=lambda video: (video.get("duration") is None, video.get("duration") or 0))
+    elif policy == "newest":
+        videos.sort(key=lambda video: video.get("pubdate") or 0, reverse=True)
+    elif policy == "uploader":
+        # the n-th video of every uploader goes before the (n+1)-th of any, folder order within a round
+        rounds: Dict[int, int] = dict()
+        ranks = list()
+        for video in videos:
+            uploader = (video.get("owner") or {}).get("mid")
+            ranks.append(rounds.get(uploader, 0))
+            rounds[uploader] = ranks[-1] + 1
+        videos = [video for _, video in sorted(zip(ranks, videos), key=lambda pair: pair[0])]
+    else:
+        raise ValueError(f"unknown order {policy}, available orders: {', '.join(ORDERS)}")
+    runtime.log(f"Ordered {len(videos)} videos by {policy}")
+    # handed out from the end, so a video is released once it is scheduled
+    videos.reverse()
+    while len(videos) > 0:
+        yield videos.pop()
+
+
+def pending(runtime: "Runtime", switch: str, video: dict, p: Optional[int]) -> bool:
+    # the checks of bget.download_video, without linking from the store
+    from . import downloader
+    if switch not in runtime.config.switches:
+        return False
+    cid = video["pages"][p]["cid"] if p is not None else 0
+    if (not runtime.args.ignore_index) and \
+            runtime.index.done(video["aid"], cid, switch, downloader.output_path(runtime, switch, video, p)):
+        return False
+    if downloader.archived(runtime, switch) and (not runtime.args.ignore_index) and \
+            runtime.archive.has(downloader.archive_entry(runtime, switch, video, p)):
+        return False
+    key = downloader.store_key(runtime, switch, video, p)
+    return key is None or runtime.store.find(key) is None
+
+
+def probe_tracks(runtime: "Runtime", video: dict, p: int, kinds: List[str]) -> Dict[str, int]:
+    from . import downloader, transfer
+    aid, cid = video["aid"], video["pages"][p]["cid"]
+    with runtime.metrics.time("resolve"):
+        stream = runtime.retry.call(aid, downloader.get_av_stream_url, runtime, "", aid, cid, logger=runtime.log)
+    options = transfer.TransferOptions(stall_timeout=runtime.config.stall_timeout, session=runtime.bapi.session,
+                                       hosts=runtime.bapi.connections)
+    sizes = dict()
+    for kind in kinds:
+        sizes[kind], _ = runtime.retry.call(aid, transfer.probe, [stream[kind]], options, logger=runtime.log)
+    return sizes
+
+
+class Estimate:
+    def __init__(self):
+        self.videos = 0
+        # files and estimated bytes of every switch, bytes of danmaku, covers and metadata are not known
+        self.files: Dict[str, int] = dict()
+        self.sizes: Dict[str, int] = dict()
+        # bytes received, a track shared by the audio and video outputs is received once
+        self.received = 0
+        self.unknown = 0
+
+    def add(self, switch: str, size: int = 0):
+        self.files[switch] = self.files.get(switch, 0) + 1
+        self.sizes[switch] = self.sizes.get(switch, 0) + size
+
+    def merge(self, other: "Estimate"):
+        self.videos += other.videos
+        for switch, files in other.files.items():
+            self.files[switch] = self.files.get(switch, 0) + files
+            self.sizes[switch] = self.sizes.get(switch, 0) + other.sizes[switch]
+        self.received += other.received
+        self.unknown += other.unknown
+
+
+def estimate(runtime: "Runtime", video: dict) -> Estimate:
+    from .retry import describe_error
+    result = Estimate()
+    for p in range(len(video["pages"])):
+        streams = [switch for switch in ["audio", "video"] if pending(runtime, switch, video, p)]
+        if len(streams) > 0:
+            try:
+                tracks = probe_tracks(runtime, video, p, ["audio"] if streams == ["audio"] else ["audio", "video"])
+            except Exception as e:
+                runtime.log(f"Can not estimate av{video['aid']} P{p+1}: {describe_error(e)}")
+                result.unknown += 1
+                tracks = None
+            for switch in streams:
+                if tracks is not None:
+                    result.add(switch, tracks["audio"] + (tracks["video"] if switch == "video" else 0))
+            if tracks is not None:
+                result.received += sum(tracks.values())
+        if pending(runtime, "danmaku", video, p):
+            result.add("danmaku")
+    for switch in ["cover", "meta"]:
+        if pending(runtime, switch, video, None):
+            result.add(switch)
+    if len(result.files) > 0 or result.unknown > 0:
+        result.videos = 1
+    return result
+
+
+def duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def print_estimate(title: str, result: Estimate, history: Throughput):
+    print(f"\n{title}: {result.videos} videos to download")
+    for switch in ["video", "audio", "danmaku", "cover", "meta"]:
+        if switch not in result.files:
+            continue
+        size = f"{result.sizes[switch] / 1024 / 1024:.2f}M" if switch in ["audio", "video"] else "-"
+        print(f"    {switch:<10} {result.files[switch]:>8} files {size:>12}")
+    print(f"    Download: {result.received / 1024 / 1024:.2f}M" +
+          (f", {result.unknown} parts not estimated" if result.unknown > 0 else ""))
+    rate = history.rate()
+    if rate is None:
+        print("    ETA: unknown, no download measured yet")
+    else:
+        print(f"    ETA: {duration(result.received / rate)} at {rate / 1024 / 1024:.2f}M/s "
+              f"measured over the last {len(history.samples)} runs")
+
+
+def plan(runtimes: List["Runtime"]):
+    # lists and checks out like a download, then asks the stream server for the size of every track
+    from concurrent.futures import ThreadPoolExecutor
+    from .bget import checkout_videos, fail_listing, guard_listing, list_section
+    history = Throughput(runtimes[0].config.cache)
+    estimates = list()
+    # a section whose listing failed is reported like in a download, the others are still estimated
+    unlisted = set()
+    for runtime in runtimes:
+        try:
+            _, _, tasks = list_section(runtime, tick=False)
+        except Exception as e:
+            fail_listing(runtime, e, unlisted)
+            tasks = list()
+        if not isinstance(tasks, list):
+            tasks = guard_listing(runtime, tasks, unlisted)
+        videos = order_videos(runtime, checkout_videos(runtime, tasks))
+        section = Estimate()
+        with ThreadPoolExecutor(max_workers=max(1, runtime.config.checkout_jobs),
+                                thread_name_prefix="bget-plan") as pool:
+            for result in pool.map(lambda video: estimate(runtime, video), videos):
+                section.merge(result)
+        name = runtime.section_name or f"{runtime.resource_type}:{runtime.resource_id}"
+        if runtime.section_name in unlisted:
+            name += " (listing failed, only the videos listed before are counted)"
+        estimates.append((name, section))
+
+    print("=" * 80)
+    print("Download Plan")
+    total = Estimate()
+    for name, section in estimates:
+        print_estimate(name, section, history)
+        total.merge(section)
+    if len(estimates) > 1:
+        print_estimate("All sections", total, history)
+    print("\n\nEnd of Download Plan")
+    print("=" * 80, "\n")
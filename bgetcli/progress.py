@@ -0,0 +1,122 @@
+import sys
+import time
+import threading
+from typing import List, Optional, TextIO
+
+MODES = ["auto", "bar", "summary", "none"]
+BAR_INTERVAL = 0.1
+SUMMARY_INTERVAL = 10.0
+MAX_LINES = 8
+
+
+class Transfer:
+    __slots__ = ("tag", "total", "finished", "lock", "started_at", "sampled_at", "sampled", "speed")
+
+    def __init__(self, tag: str, total: int, finished: int = 0):
+        self.tag = tag
+        self.total = total
+        self.finished = finished
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.sampled_at = self.started_at
+        self.sampled = finished
+        self.speed = 0.0
+
+    def advance(self, length: int):
+        # the only work done per chunk, everything else happens on the ticker thread
+        with self.lock:
+            self.finished += length
+
+    def sample(self, now: float) -> float:
+        elapsed = now - self.sampled_at
+        if elapsed > 0:
+            current = (self.finished - self.sampled) / elapsed
+            self.speed = current if self.speed == 0 else self.speed * 0.7 + current * 0.3
+            self.sampled_at = now
+            self.sampled = self.finished
+        return self.speed
+
+    def render(self) -> str:
+        frac = self.finished / self.total if self.total > 0 else 0
+        bar = ("=" * int(frac * 15 - 1) + ">") if frac > 0 else ""
+        return "{tag}: {percent:<7} [{bar:<15}] {finished:.2f}/{total:.2f}M {speed:.2f}K/s".format(
+            tag=self.tag, percent=f"{frac:.2%}", bar=bar, finished=self.finished / 1024 / 1024,
+            total=self.total / 1024 / 1024, speed=self.speed / 1024)
+
+
+class ProgressBoard:
+    def __init__(self, mode: str = "auto", output: TextIO = sys.stdout):
+        if mode == "auto":
+            mode = "bar" if output.isatty() else "summary"
+        self.mode = mode
+        self.output = output
+        self.lock = threading.RLock()
+        self.transfers: List[Transfer] = list()
+        self.drawn = 0
+        self.ticker: Optional[threading.Thread] = None
+        self.closed = threading.Event()
+
+    def start(self, tag: str, total: int, finished: int = 0) -> Transfer:
+        transfer = Transfer(tag, total, finished)
+        with self.lock:
+            self.transfers.append(transfer)
+            if self.ticker is None and self.mode != "none":
+                self.ticker = threading.Thread(target=self.tick, name="bget-progress", daemon=True)
+                self.ticker.start()
+        return transfer
+
+    def finish(self, transfer: Transfer):
+        with self.lock:
+            if transfer in self.transfers:
+                self.transfers.remove(transfer)
+
+    def print(self, line: str):
+        with self.lock:
+            self.clear()
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def clear(self):
+        if self.drawn > 0:
+            self.output.write(f"\x1b[{self.drawn}F\x1b[J")
+            self.drawn = 0
+
+    def draw(self, now: float):
+        for transfer in self.transfers[:MAX_LINES]:
+            transfer.sample(now)
+        lines = [transfer.render() for transfer in self.transfers[:MAX_LINES]]
+        if len(self.transfers) > MAX_LINES:
+            lines.append(f"... {len(self.transfers) - MAX_LINES} more transfers")
+        self.clear()
+        if len(lines) > 0:
+            self.output.write("\n".join(lines) + "\n")
+        self.output.flush()
+        self.drawn = len(lines)
+
+    def summarize(self, now: float):
+        if len(self.transfers) == 0:
+            return
+        speed = sum(transfer.sample(now) for transfer in self.transfers)
+        finished = sum(transfer.finished for transfer in self.transfers)
+        total = sum(transfer.total for transfer in self.transfers)
+        self.output.write("[{clock}][progress]{count} transfers {finished:.2f}/{total:.2f}M {speed:.2f}K/s\n".format(
+            clock=time.strftime("%H:%M:%S"), count=len(self.transfers), finished=finished / 1024 / 1024,
+            total=total / 1024 / 1024, speed=speed / 1024))
+        self.output.flush()
+
+    def tick(self):
+        interval = BAR_INTERVAL if self.mode == "bar" else SUMMARY_INTERVAL
+        while not self.closed.wait(interval):
+            with self.lock:
+                if self.mode == "bar":
+                    self.draw(time.monotonic())
+                else:
+                    self.summarize(time.monotonic())
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self.transfers.clear()
+            if self.mode == "bar":
+                self.clear()
+                self.output.flush()
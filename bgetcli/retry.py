@@ -0,0 +1,97 @@
+import time
+import random
+import threading
+import subprocess
+from typing import Callable, Dict, Hashable, Optional, TypeVar
+
+import requests
+
+from .api import APIError
+from .limiter import CircuitBreaker
+from .metrics import Metrics
+from .transfer import TransferError
+
+T = TypeVar("T")
+
+# api codes worth another try: blocked or throttled requests and server side failures
+TRANSIENT_API_CODES = {-412, -509, -352, -500, -503, -504}
+TRANSIENT_HTTP_STATUS = {408, 412, 425, 429, 500, 502, 503, 504}
+MAX_DELAY = 60.0
+
+
+def is_transient(e: BaseException) -> bool:
+    if isinstance(e, APIError):
+        return e.code in TRANSIENT_API_CODES
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code in TRANSIENT_HTTP_STATUS
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, TransferError, TimeoutError, ConnectionError)):
+        return True
+    # ffmpeg failures, missing fields in api data and the like do not go away by asking again
+    return False
+
+
+def describe_error(e: BaseException) -> str:
+    if isinstance(e, RetryExhausted):
+        return f"{describe_error(e.cause)} (gave up after {e.attempts} attempts)"
+    if isinstance(e, subprocess.CalledProcessError) and e.stderr:
+        lines = e.stderr.decode("utf-8", errors="replace").strip().splitlines()
+        if len(lines) > 0:
+            return f"ffmpeg exited with {e.returncode}: {lines[-1]}"
+    return str(e) or type(e).__name__
+
+
+class RetryExhausted(Exception):
+    def __init__(self, cause: BaseException, attempts: int):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.attempts = attempts
+
+
+class Retry:
+    def __init__(self, attempts: int, budget: int, delay: float, breaker: Optional[CircuitBreaker] = None,
+                 metrics: Optional[Metrics] = None):
+        self.attempts = max(1, attempts)
+        self.breaker = breaker
+        self.metrics = metrics or Metrics()
+        self.budget = budget
+        self.delay = delay
+        # retries left for every item, shared by all jobs of the item
+        self.budgets: Dict[Hashable, int] = dict()
+        self.lock = threading.Lock()
+
+    def spend(self, key: Hashable) -> bool:
+        with self.lock:
+            remains = self.budgets.get(key, self.budget)
+            if remains <= 0:
+                return False
+            self.budgets[key] = remains - 1
+            return True
+
+    def reset(self):
+        # budgets are per run, a long running process starts every run with full budgets
+        with self.lock:
+            self.budgets.clear()
+
+    def backoff(self, attempt: int) -> float:
+        # exponential with jitter, so workers throttled together do not come back together
+        return min(MAX_DELAY, self.delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+    def call(self, key: Hashable, func: Callable[..., T], *args, logger: Optional[Callable] = None) -> T:
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except Exception as e:
+                if not is_transient(e):
+                    raise
+                attempt += 1
+                if attempt >= self.attempts or not self.spend(key):
+                    self.metrics.count("retries_exhausted")
+                    raise RetryExhausted(e, attempt) from e
+                self.metrics.count("retries")
+                delay = self.backoff(attempt - 1)
+                if logger is not None:
+                    logger(f"Retrying in {delay:.1f}s ({attempt}/{self.attempts - 1}): {describe_error(e)}")
+                    if self.breaker is not None and self.breaker.open:
+                        logger(f"Api is rejecting requests, paused for {self.breaker.remains:.0f}s")
+                time.sleep(delay)
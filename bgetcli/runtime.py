@@ -1,89 +1,101 @@
+import copy
 import json
 import os
 import sys
 import time
 import toml
-import bgetlib
 import argparse
+import threading
 from dataclasses import dataclass, field
-from typing import Optional, Dict, List
-from .utils import list_unique, parse_resources
+from typing import Optional, Dict, List, Tuple
+from .utils import parse_resources
+from .config import Config
+from .api import BilibiliAPI
+from .scheduler import Scheduler
+from .index import CompletionIndex
+from .limiter import CircuitBreaker, DiskSpace, HostConnections, TokenBucket
+from .mirrors import HostRanking
+from .retry import Retry
+from .archive import Archive
+from .metacache import MetaCache
+from .metrics import Metrics
+from .store import ContentStore
+from .progress import ProgressBoard
 
+# settings of the pools and budgets shared by every section of a batch
+BATCH_SETTINGS = ["jobs", "merge_jobs", "small_jobs", "host_connections", "retries", "retry_budget", "retry_delay",
+                  "min_free_space"]
+
+
+class ReportEntry:
+    # the report keeps a few fields per item instead of the api dicts, big folders add up to thousands
+    __slots__ = ("id", "title", "reason")
+
+    def __init__(self, aid: Optional[int], title: str, reason: str = ""):
+        self.id = aid
+        self.title = title
+        self.reason = reason
+
+    @staticmethod
+    def of(task: dict, reason: str = "") -> "ReportEntry":
+        return ReportEntry(task["id"], task.get("title", ""), reason)
 
-@dataclass
-class Report:
-    skip: List[Dict] = field(default_factory=list)
-    error: List[Dict] = field(default_factory=list)
-    multipart: List[Dict] = field(default_factory=list)
-    inaccessible: List[Dict] = field(default_factory=list)
+
+class MultipartEntry:
+    __slots__ = ("id", "title", "parts")
+
+    def __init__(self, video: dict):
+        self.id = video["aid"]
+        self.title = video["title"]
+        # cid and name of every part
+        self.parts: Tuple[Tuple[int, str], ...] = tuple((page["cid"], page["part"]) for page in video["pages"])
+
+
+class DeduplicatedEntry:
+    __slots__ = ("id", "size")
+
+    def __init__(self, aid: int, size: int):
+        self.id = aid
+        self.size = size
 
 
 @dataclass
-class Config:
-    outdir: str
-    cookies: str
-    chunk_size: int
-    host: Optional[str]
-    switches: List[str]
-    formatter: Dict[str, str]
-
-    def load(self, raw_config: dict, section_name: Optional[str] = None):
-        override_config = raw_config
-        if section_name is not None:
-            override_config = raw_config.get("section", {}).get(section_name, {})
-        self.outdir = override_config.get("outdir", self.outdir)
-        self.cookies = override_config.get("cookies", self.cookies)
-        self.chunk_size = override_config.get("chunk-size", self.chunk_size)
-        self.host = override_config.get("host", self.host)
-        self.switches = list_unique(override_config.get("switches", self.switches))
-        for key in ["meta", "audio", "video", "cover", "danmaku"]:
-            self.formatter[key] = override_config.get("formatter-" + key, self.formatter[key])
-
-    def load_args(self, args: argparse.Namespace):
-        self.cookies = args.cookies or self.cookies
-        self.outdir = args.outdir or self.outdir
-        self.chunk_size = args.chunk_size or self.chunk_size
-        self.host = args.host or self.host
-        if args.meta:
-            self.switches.append("meta")
-            self.switches = list_unique(self.switches)
-        if args.danmaku:
-            self.switches.append("danmaku")
-            self.switches = list_unique(self.switches)
-        if args.cover:
-            self.switches.append("cover")
-            self.switches = list_unique(self.switches)
-        if args.audio_only:
-            self.switches.append("audio")
-            self.switches = list_unique(self.switches)
-            self.switches.remove("video")
-
-    def print_self(self, logger):
-        logger(
-            "Calculated configuration:",
-            f"dest={self.outdir}",
-            f"cookies={self.cookies}",
-            f"chunk_size={self.chunk_size}",
-            f"host={self.host}"
-        )
-        logger(f"Switches: {', '.join(self.switches)}")
-        logger(f"Formatters:")
-        for key, value in self.formatter.items():
-            logger(f"  {key}: {value}")
+class Report:
+    skip: List[ReportEntry] = field(default_factory=list)
+    error: List[ReportEntry] = field(default_factory=list)
+    multipart: List[MultipartEntry] = field(default_factory=list)
+    inaccessible: List[ReportEntry] = field(default_factory=list)
+    removed: List[ReportEntry] = field(default_factory=list)
+    deduplicated: List[DeduplicatedEntry] = field(default_factory=list)
 
 
 @dataclass
 class Runtime:
-    bapi: bgetlib.BilibiliAPI
+    bapi: BilibiliAPI
     args: argparse.Namespace
     report: Report
     config: Config
     section_name: str
     resource_type: str
     resource_id: int
-    log_tags: List[str] = field(init=False, default_factory=list)
+    scheduler: Scheduler
+    progress: ProgressBoard
+    limiter: TokenBucket
+    mirrors: Optional[HostRanking]
+    retry: Retry
+    meta: MetaCache
+    store: Optional[ContentStore]
+    metrics: Metrics
+    space: DiskSpace
+    log_prefix: Optional[str] = None
+    index: CompletionIndex = field(init=False)
+    archive: Optional[Archive] = field(init=False)
+    # errors of this section, the report holds those of the whole batch
+    failed: List[ReportEntry] = field(init=False)
 
     def __post_init__(self):
+        self._local = threading.local()
+        self.failed = list()
         self.log_time_format = "%Y-%m-%d %H:%M:%S" if self.args.log_include_date else "%H:%M:%S"
         if self.resource_type == "notfound":
             self.log("Section name not found in configuration")
@@ -92,36 +104,118 @@ class Runtime:
             self.log("Can not parse resource")
             sys.exit()
         self.config.print_self(self.log)
+        self.index = CompletionIndex.open(self.config.outdir)
+        self.archive = None
+        if self.config.archive is not None:
+            self.archive = Archive.open(self.config.outdir, self.section_name, self.config.archive)
         self.log(f"Fetching resource {self.resource_type}:{self.resource_id}")
 
     @staticmethod
-    def factory(args: argparse.Namespace, config: Config):
-        section_name: str = args.resource.strip() if args.section else None
+    def section_names(args: argparse.Namespace, config_dict: dict) -> List[Optional[str]]:
+        if args.all_sections:
+            return list(config_dict.get("section", {}).keys())
+        if args.section:
+            return [name.strip() for name in args.resource.split(",") if name.strip() != ""]
+        return [None]
+
+    @staticmethod
+    def factory(args: argparse.Namespace, config: Config,
+                apis: Optional[Dict[str, BilibiliAPI]] = None) -> List["Runtime"]:
+        # sections of one batch share the api session, the worker pools and the report,
+        # api sessions passed in are reused with their cookies and open connections
         config_dict = toml.load(args.config) if args.config is not None else {"section": {}}
-        config = Runtime.build_config(args, config, section_name)
-        resource_type, resource_id = parse_resources(args, config_dict)
-        bapi = bgetlib.BilibiliAPI(config.cookies)
+        global_config = Runtime.build_config(args, copy.deepcopy(config), config_dict, None)
+        section_names = Runtime.section_names(args, config_dict)
+        # a section running alone sizes the pools itself, several sections share the global settings
+        batch_config = global_config
+        if len(section_names) == 1:
+            batch_config = Runtime.build_config(args, copy.deepcopy(config), config_dict, section_names[0])
+        pool_size = max(16, batch_config.jobs * batch_config.connections + batch_config.checkout_jobs
+                        + batch_config.small_jobs)
+        metrics = Metrics()
+        scheduler = Scheduler(batch_config.jobs, batch_config.merge_jobs, batch_config.small_jobs, metrics)
+        progress = ProgressBoard(args.progress)
+        # the batch shares one bandwidth budget, a section with its own limit-rate is capped again within it
+        limiter = TokenBucket(global_config.limit_rate)
+        connections = HostConnections(batch_config.host_connections)
+        space = DiskSpace(batch_config.min_free_space)
+        # retry budgets are kept per item, an item listed by two sections shares one
+        breaker = CircuitBreaker()
+        retry = Retry(batch_config.retries + 1, batch_config.retry_budget, batch_config.retry_delay, breaker,
+                      metrics)
+        meta = MetaCache(global_config.cache, global_config.meta_max_age, global_config.meta_cache_size * 1024 * 1024,
+                         global_config.offline_meta)
         report = Report()
-        return Runtime(bapi, args, report, config, section_name, resource_type, resource_id)
+        apis = apis if apis is not None else dict()
+        reused = set()
+        rankings: Dict[tuple, HostRanking] = dict()
+        stores: Dict[str, ContentStore] = dict()
+        runtimes = list()
+        for section_name in section_names:
+            section_config = Runtime.build_config(args, copy.deepcopy(config), config_dict, section_name)
+            # the printed configuration shows what the section runs with
+            ignored = [key for key in BATCH_SETTINGS if getattr(section_config, key) != getattr(batch_config, key)]
+            for key in ignored:
+                setattr(section_config, key, getattr(batch_config, key))
+            resource_name = section_name if section_name is not None else args.resource.strip()
+            resource_type, resource_id = parse_resources(resource_name, section_name is not None, config_dict)
+            if section_config.cookies not in apis:
+                apis[section_config.cookies] = BilibiliAPI(section_config.cookies, pool_size, connections, breaker)
+            elif section_config.cookies not in reused:
+                apis[section_config.cookies].connections = connections
+                apis[section_config.cookies].breaker = breaker
+            reused.add(section_config.cookies)
+            section_limiter = limiter
+            if section_config.limit_rate != global_config.limit_rate:
+                section_limiter = TokenBucket(section_config.limit_rate, parent=limiter)
+            mirrors = None
+            if section_config.host is None and len(section_config.hosts) > 0:
+                key = tuple(section_config.hosts)
+                if key not in rankings:
+                    rankings[key] = HostRanking(section_config.cache, section_config.hosts,
+                                                section_config.host_ranking_ttl)
+                mirrors = rankings[key]
+            store = None
+            if section_config.store is not None:
+                root = os.path.abspath(section_config.store)
+                if root not in stores:
+                    stores[root] = ContentStore(root, section_config.store_link)
+                store = stores[root]
+            log_prefix = section_name if len(section_names) > 1 else None
+            runtimes.append(Runtime(apis[section_config.cookies], args, report, section_config, section_name,
+                                    resource_type, resource_id, scheduler, progress, section_limiter, mirrors,
+                                    retry, meta, store, metrics, space, log_prefix))
+            if len(ignored) > 0:
+                runtimes[-1].log("Shared by all sections, ignored in this one: " +
+                                 ", ".join(key.replace("_", "-") for key in ignored))
+        return runtimes
 
     @staticmethod
-    def build_config(args: argparse.Namespace, config: Config, section_name: str) -> Config:
-        config_dict = toml.load(args.config) if args.config is not None else {"section": {}}
+    def build_config(args: argparse.Namespace, config: Config, config_dict: dict,
+                     section_name: Optional[str]) -> Config:
         config.load(config_dict)
         config.load_args(args)
-        if args.section:
+        if section_name is not None:
             config.load(config_dict, section_name)
         return config
 
-    def log(self, *values, **kwargs):
-        tags = "".join([f"[{tag}]" for tag in self.log_tags])
-        print(f"[{time.strftime(self.log_time_format)}]" + tags, end="")
-        print(*values, **kwargs)
+    def fail(self, entry: ReportEntry):
+        self.report.error.append(entry)
+        self.failed.append(entry)
+
+    @property
+    def log_tags(self) -> List[str]:
+        # every worker thread carries its own tag stack
+        if not hasattr(self._local, "tags"):
+            self._local.tags = list()
+        return self._local.tags
 
-    def log_progress(self, *values, **kwargs):
-        kwargs["end"] = "\r"
-        kwargs["flush"] = True
-        self.log(*values, **kwargs)
+    def log(self, *values, sep: str = " "):
+        tags = "".join([f"[{tag}]" for tag in self.log_tags])
+        if self.log_prefix is not None:
+            tags = f"[{self.log_prefix}]" + tags
+        # lines go through the progress board, so they are printed above the live bars
+        self.progress.print(f"[{time.strftime(self.log_time_format)}]" + tags + sep.join(str(v) for v in values))
 
 
 class SectionHead:
@@ -145,17 +239,27 @@ class SectionHead:
         return head_timestamp or 172800
 
     def write(self):
-        if self.runtime.section_name is None:
+        SectionHead.write_all([self])
+
+    @staticmethod
+    def write_all(section_heads: List["SectionHead"]):
+        section_heads = [head for head in section_heads if head.runtime.section_name is not None]
+        if len(section_heads) == 0:
             return
-        if self.tick_at is None:
-            self.runtime.log("Error: can not write before tick")
-            sys.exit()
-        if not os.path.exists(self.filename):
+        for head in section_heads:
+            if head.tick_at is None:
+                head.runtime.log("Error: can not write before tick")
+                sys.exit()
+        filename = section_heads[0].filename
+        if not os.path.exists(filename):
             heads = {}
         else:
-            with open(self.filename, "r", encoding="utf-8") as f:
+            with open(filename, "r", encoding="utf-8") as f:
                 heads = json.load(f)
-        self.runtime.log(f"Writing head timestamp: {self.tick_at}")
-        heads[self.runtime.section_name] = self.tick_at
-        with open(self.filename, "w+", encoding="utf-8") as f:
+        for head in section_heads:
+            head.runtime.log(f"Writing head timestamp: {head.tick_at}")
+            heads[head.runtime.section_name] = head.tick_at
+        # every section of the batch is written at once, a crash never leaves a half written head
+        with open(filename + ".tmp", "w+", encoding="utf-8") as f:
             f.write(json.dumps(heads, ensure_ascii=False, indent=4))
+        os.replace(filename + ".tmp", filename)
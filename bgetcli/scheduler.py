@@ -0,0 +1,163 @@
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+from .metrics import Metrics
+
+
+def chain(future: Future, then: Callable[[Future], Any]) -> Future:
+    chained = Future()
+
+    def on_done(f: Future):
+        try:
+            chained.set_result(then(f))
+        except BaseException as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(on_done)
+    return chained
+
+
+def timed(func: Callable, *args) -> Tuple[float, Any]:
+    # runs in the worker process, the time spent waiting in the queue is left out
+    started_at = time.monotonic()
+    result = func(*args)
+    return time.monotonic() - started_at, result
+
+
+class Scheduler:
+    def __init__(self, jobs: int, merge_jobs: int, small_jobs: int = 8, metrics: Optional[Metrics] = None,
+                 backlog: int = 0):
+        self.jobs = max(1, jobs)
+        self.merge_jobs = max(1, merge_jobs)
+        self.small_jobs = max(1, small_jobs)
+        self.fetch_pool = ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="bget-fetch")
+        # danmaku and covers are a request each, they run beside the stream downloads instead of taking their turns
+        self.small_pool = ThreadPoolExecutor(max_workers=self.small_jobs, thread_name_prefix="bget-small")
+        self.postprocess_pool = ProcessPoolExecutor(max_workers=self.merge_jobs,
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        # unfinished jobs only, a finished one is dropped with the video and closures it holds
+        self.futures: Set[Future] = set()
+        self.failure: Optional[BaseException] = None
+        self.changed = threading.Condition()
+        # unfinished jobs allowed before admit() blocks the producer, enough to keep every pool busy
+        self.backlog = backlog or 2 * (self.jobs + self.small_jobs) + self.merge_jobs
+        self.metrics = metrics or Metrics()
+
+    def submit(self, runtime, func: Callable, *args, small: bool = False) -> Future:
+        # a job may hand its remaining work to the post-processing queue by returning a future,
+        # the job is finished when that future is
+        tags = list(runtime.log_tags)
+        job = Future()
+        queue = "small" if small else "fetch"
+        self.metrics.queue(queue, 1)
+
+        def run():
+            self.metrics.queue(queue, -1)
+            if job.cancelled():
+                return
+            runtime.log_tags[:] = tags
+            try:
+                result = func(runtime, *args)
+            except BaseException as e:
+                Scheduler.resolve(job, exception=e)
+                return
+            finally:
+                runtime.log_tags.clear()
+            if isinstance(result, Future):
+                result.add_done_callback(lambda f: Scheduler.follow(job, f))
+            else:
+                Scheduler.resolve(job, result)
+
+        self.keep(job)
+        (self.small_pool if small else self.fetch_pool).submit(run)
+        return job
+
+    @staticmethod
+    def resolve(job: Future, result: Any = None, exception: Optional[BaseException] = None):
+        if job.cancelled():
+            return
+        if exception is not None:
+            job.set_exception(exception)
+        else:
+            job.set_result(result)
+
+    @staticmethod
+    def follow(job: Future, future: Future):
+        if future.exception() is not None:
+            Scheduler.resolve(job, exception=future.exception())
+        else:
+            Scheduler.resolve(job, future.result())
+
+    def track(self, future: Future) -> Future:
+        # work not submitted here, such as a callback of another job, is still waited for
+        self.keep(future)
+        return future
+
+    def keep(self, future: Future):
+        with self.changed:
+            self.futures.add(future)
+        future.add_done_callback(self.finished)
+
+    def finished(self, future: Future):
+        with self.changed:
+            self.futures.discard(future)
+            if not future.cancelled() and future.exception() is not None and self.failure is None:
+                self.failure = future.exception()
+            self.changed.notify_all()
+
+    def admit(self):
+        # backpressure for the listing and checkout stages, they pull the next video only when there is room
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.futures) < self.backlog or self.failure is not None)
+
+    def postprocess(self, func: Callable, *args) -> Future:
+        # the merge queue counts jobs waiting and running
+        submitted_at = time.monotonic()
+        self.metrics.queue("merge", 1)
+
+        def unpack(f: Future) -> Any:
+            self.metrics.queue("merge", -1)
+            if f.exception() is not None:
+                self.metrics.observe("merge", time.monotonic() - submitted_at, failed=True)
+                raise f.exception()
+            seconds, result = f.result()
+            self.metrics.observe("merge", seconds)
+            return result
+        return chain(self.postprocess_pool.submit(timed, func, *args), unpack)
+
+    @staticmethod
+    def when_done(futures: List[Future], callback: Callable[[], None]):
+        if len(futures) == 0:
+            callback()
+            return
+        remains = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(_: Future):
+            with lock:
+                remains[0] -= 1
+                if remains[0] != 0:
+                    return
+            callback()
+
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def wait(self):
+        # the first failure aborts the batch
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.futures) == 0 or self.failure is not None)
+            failure, self.failure = self.failure, None
+            remains = list(self.futures)
+        if failure is not None:
+            for future in remains:
+                future.cancel()
+            raise failure
+
+    def shutdown(self):
+        self.fetch_pool.shutdown(wait=True)
+        self.small_pool.shutdown(wait=True)
+        self.postprocess_pool.shutdown(wait=True)
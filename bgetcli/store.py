@@ -0,0 +1,87 @@
+import os
+import shutil
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+LINK_MODES = ["auto", "hardlink", "reflink", "copy"]
+FICLONE = 0x40049409
+
+
+def reflink(source: str, dest: str):
+    # copy on write clone, supported by btrfs, xfs and the like on linux
+    import fcntl
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(dest)
+            raise
+
+
+def copy(source: str, dest: str):
+    shutil.copyfile(source, dest)
+
+
+LINKERS: Dict[str, Callable[[str, str], None]] = {"hardlink": os.link, "reflink": reflink, "copy": copy}
+
+
+class ContentStore:
+    def __init__(self, root: str, link_mode: str = "auto"):
+        self.root = root
+        self.modes: List[str] = ["hardlink", "reflink", "copy"] if link_mode == "auto" else [link_mode]
+        self.lock = threading.Lock()
+        # jobs producing an entry, another section wanting the same entry links to it once it is done
+        self.inflight: Dict[str, "Future"] = dict()
+
+    @staticmethod
+    def key(video: dict, part: Optional[int], name: str, profile: str = "") -> str:
+        cid = video["pages"][part]["cid"] if part is not None else 0
+        return f"av{video['aid']}/{cid}/{name}" + (f"-{profile}" if profile else "")
+
+    def base(self, key: str, extension: str) -> str:
+        # extensions decided while downloading, such as the audio codec, are appended to this
+        return os.path.join(self.root, key + "." + extension)
+
+    def find(self, key: str) -> Optional[str]:
+        directory, name = os.path.split(os.path.join(self.root, key))
+        if not os.path.isdir(directory):
+            return None
+        for filename in os.listdir(directory):
+            if filename.startswith(name + ".") and not filename.endswith((".part", ".part.json", ".link", ".tmp")):
+                return os.path.join(directory, filename)
+        return None
+
+    def link(self, stored: str, dest: str) -> str:
+        temporary = dest + ".link"
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        errors = list()
+        for mode in self.modes:
+            try:
+                LINKERS[mode](stored, temporary)
+                break
+            except OSError as e:
+                # a hardlink can not cross devices, a reflink needs a supporting filesystem
+                errors.append(e)
+        else:
+            raise errors[-1]
+        os.replace(temporary, dest)
+        return dest
+
+    def claim(self, key: str, future: "Future"):
+        with self.lock:
+            self.inflight[key] = future
+
+        def release(_: "Future"):
+            with self.lock:
+                if self.inflight.get(key) is future:
+                    del self.inflight[key]
+        future.add_done_callback(release)
+
+    def producing(self, key: str) -> Optional["Future"]:
+        with self.lock:
+            return self.inflight.get(key)
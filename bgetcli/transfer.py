@@ -0,0 +1,331 @@
+import os
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import requests
+
+from .limiter import HostConnections, TokenBucket
+from .progress import ProgressBoard, Transfer
+
+HEADERS = {
+    "User-Agent": "Bilibili Freedoooooom/MarkII",
+    "Referer": "https://www.bilibili.com/",
+    "Accept": "*/*",
+}
+MIN_SEGMENT_SIZE = 1024 * 1024
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+CHUNK_READ_TIME = 0.05
+SAVE_INTERVAL = 1.0
+TIMEOUT = 30
+
+
+class TransferError(IOError):
+    pass
+
+
+class TransferStalled(TransferError):
+    pass
+
+
+# errors after which the same bytes are requested again from the next host
+STALLS = (TransferStalled, requests.ConnectionError, requests.Timeout, TimeoutError)
+
+
+@dataclass
+class TransferOptions:
+    chunk_size: int = 8192
+    connections: int = 1
+    adaptive: bool = True
+    # a transfer receiving less than MIN_CHUNK_SIZE within this many seconds is stalled, 0 to wait forever
+    stall_timeout: float = 0
+    limiter: Optional[TokenBucket] = None
+    board: Optional[ProgressBoard] = None
+    session: Optional[requests.Session] = None
+    hosts: Optional[HostConnections] = None
+    on_stall: Optional[Callable[[str], None]] = None
+
+
+class PartState:
+    def __init__(self, path: str, url: str, size: int, segments: List[List[int]]):
+        self.path = path
+        self.url = url
+        self.size = size
+        # [start, end, written] of every byte range, written only counts bytes flushed to disk
+        self.segments = segments
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def load(path: str) -> Optional["PartState"]:
+        if not os.path.exists(path):
+            return None
+        # noinspection PyBroadException
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            return PartState(path, state["url"], int(state["size"]), [list(s) for s in state["segments"]])
+        except Exception:
+            return None
+
+    def same_track(self, url: str, size: int) -> bool:
+        # hosts and signed query strings change between runs, the path names the track and its quality
+        return self.size == size and urlparse(self.url).path == urlparse(url).path
+
+    @property
+    def written(self) -> int:
+        return sum(segment[2] for segment in self.segments)
+
+    @property
+    def complete(self) -> bool:
+        return self.size > 0 and self.written == self.size
+
+    def commit(self, index: int, written: int):
+        with self.lock:
+            self.segments[index][2] = written
+            self.save()
+
+    def save(self):
+        state = {"url": self.url, "size": self.size, "written": self.written, "segments": self.segments}
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps(state))
+        os.replace(self.path + ".tmp", self.path)
+
+
+def parse_content_range(value: str) -> Optional[Tuple[int, int, int]]:
+    matched = re.match(r"^bytes (\d+)-(\d+)/(\d+)$", value or "")
+    if matched is None:
+        return None
+    return int(matched.group(1)), int(matched.group(2)), int(matched.group(3))
+
+
+@contextmanager
+def open_stream(url: str, headers: dict, options: TransferOptions) -> Iterator[requests.Response]:
+    # the connection slot of the host is held until the body is read
+    timeout = (TIMEOUT, options.stall_timeout or TIMEOUT)
+    with (options.hosts or HostConnections()).hold(url), \
+            (options.session or requests).get(url, headers=headers, stream=True, timeout=timeout) as r:
+        yield r
+
+
+def failover(urls: List[str], options: TransferOptions, attempt: Callable[[str], None]):
+    # the same request moves on to the next host when one stalls, the last host's error is raised
+    for index, url in enumerate(urls):
+        try:
+            return attempt(url)
+        except STALLS:
+            if index == len(urls) - 1:
+                raise
+            if options.on_stall is not None:
+                options.on_stall(url)
+
+
+def probe(urls: List[str], options: TransferOptions) -> Tuple[int, bool]:
+    def attempt(url: str) -> Tuple[int, bool]:
+        with open_stream(url, dict(HEADERS, Range="bytes=0-0"), options) as r:
+            r.raise_for_status()
+            content_range = parse_content_range(r.headers.get("Content-Range"))
+            if r.status_code == 206 and content_range is not None:
+                return content_range[2], True
+            return int(r.headers.get("Content-Length") or 0), False
+    return failover(urls, options, attempt)
+
+
+def read_chunks(r: requests.Response, options: TransferOptions) -> Iterator[memoryview]:
+    # chunks are views into one reusable buffer, each is only valid until the next one is read
+    limiter = options.limiter
+    window_at, window_received = time.monotonic(), 0
+    for chunk in read_buffered(r, options):
+        if options.stall_timeout > 0:
+            window_received += len(chunk)
+            if time.monotonic() - window_at > options.stall_timeout:
+                if window_received < MIN_CHUNK_SIZE:
+                    raise TransferStalled(f"less than {MIN_CHUNK_SIZE} bytes in {options.stall_timeout}s")
+                window_at, window_received = time.monotonic(), 0
+        if limiter is not None:
+            limiter.acquire(len(chunk))
+        yield chunk
+
+
+def read_buffered(r: requests.Response, options: TransferOptions) -> Iterator[memoryview]:
+    raw = getattr(r.raw, "_fp", None)
+    if r.headers.get("Content-Encoding", "identity") != "identity" or not hasattr(raw, "readinto"):
+        for chunk in r.iter_content(chunk_size=options.chunk_size):
+            yield memoryview(chunk)
+        return
+    ceiling = MAX_CHUNK_SIZE
+    if options.limiter is not None and options.limiter.effective_rate > 0:
+        # under a rate limit large reads turn into long sleeps, keep a read around a tenth of a second
+        ceiling = min(ceiling, max(MIN_CHUNK_SIZE, int(options.limiter.effective_rate / 10)))
+    adaptive = options.adaptive
+    size = min(max(options.chunk_size, MIN_CHUNK_SIZE), ceiling) if adaptive else options.chunk_size
+    view = memoryview(bytearray(ceiling if adaptive else options.chunk_size))
+    while True:
+        read_at = time.monotonic()
+        length = raw.readinto(view[:size])
+        if length == 0:
+            break
+        if adaptive:
+            # grow while a read fills the buffer quickly, shrink when the link can not keep up,
+            # so a slow stream still reports progress often
+            elapsed = time.monotonic() - read_at
+            if length == size and elapsed < CHUNK_READ_TIME / 4:
+                size = min(size * 2, ceiling)
+            elif elapsed > CHUNK_READ_TIME:
+                size = max(size // 2, MIN_CHUNK_SIZE)
+        yield view[:length]
+    # the body was read past urllib3, hand the connection back to the pool ourselves
+    r.raw.release_conn()
+
+
+def split(size: int, connections: int) -> List[Tuple[int, int]]:
+    segment_size = -(-size // connections)
+    return [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+
+
+def part_paths(dest: str) -> Tuple[str, str]:
+    return dest + ".part", dest + ".part.json"
+
+
+def fetch_segment(url: str, part: str, state: PartState, index: int, tracker: Transfer, options: TransferOptions):
+    start, end, written = state.segments[index]
+    if start + written > end:
+        return
+    headers = dict(HEADERS, Range=f"bytes={start + written}-{end}")
+    with open_stream(url, headers, options) as r:
+        r.raise_for_status()
+        content_range = parse_content_range(r.headers.get("Content-Range"))
+        if r.status_code != 206 or content_range is None or content_range[0] != start + written:
+            raise TransferError(f"range {start + written}-{end} is not honoured by server")
+        with open(part, "r+b") as f:
+            f.seek(start + written)
+            saved_at = time.monotonic()
+            try:
+                for chunk in read_chunks(r, options):
+                    f.write(chunk)
+                    written += len(chunk)
+                    tracker.advance(len(chunk))
+                    if time.monotonic() - saved_at > SAVE_INTERVAL:
+                        f.flush()
+                        state.commit(index, written)
+                        saved_at = time.monotonic()
+            finally:
+                f.flush()
+                state.commit(index, written)
+    if written != end - start + 1:
+        raise TransferError(f"range {start}-{end} incomplete: {written} bytes received")
+
+
+def fetch_single(url: str, part: str, state: PartState, tracker: Transfer, options: TransferOptions):
+    written = 0
+    tracker.finished = 0
+    with open_stream(url, HEADERS, options) as r:
+        r.raise_for_status()
+        with open(part, "wb") as f:
+            for chunk in read_chunks(r, options):
+                f.write(chunk)
+                written += len(chunk)
+                tracker.advance(len(chunk))
+    if state.size > 0 and written != state.size:
+        raise TransferError(f"incomplete download: {written}/{state.size} bytes received")
+    state.commit(0, written)
+
+
+def track(board: Optional[ProgressBoard], tag: str, size: int, finished: int = 0) -> Transfer:
+    if board is None:
+        return Transfer(tag, size, finished)
+    return board.start(tag, size, finished)
+
+
+def stream(urls: Union[str, List[str]], output: BinaryIO, tag: str = "",
+           options: Optional[TransferOptions] = None) -> int:
+    urls = [urls] if isinstance(urls, str) else urls
+    options = options or TransferOptions()
+    trackers: List[Transfer] = list()
+
+    def attempt(url: str):
+        # a host switch continues after the bytes already handed to the output
+        finished = trackers[0].finished if len(trackers) > 0 else 0
+        headers = dict(HEADERS, Range=f"bytes={finished}-") if finished > 0 else HEADERS
+        with open_stream(url, headers, options) as r:
+            r.raise_for_status()
+            if finished > 0:
+                content_range = parse_content_range(r.headers.get("Content-Range"))
+                if r.status_code != 206 or content_range is None or content_range[0] != finished:
+                    raise TransferError(f"range {finished}- is not honoured by server")
+            if len(trackers) == 0:
+                trackers.append(track(options.board, tag, int(r.headers.get("Content-Length") or 0)))
+            for chunk in read_chunks(r, options):
+                output.write(chunk)
+                trackers[0].advance(len(chunk))
+
+    try:
+        failover(urls, options, attempt)
+    finally:
+        if options.board is not None and len(trackers) > 0:
+            options.board.finish(trackers[0])
+    tracker = trackers[0]
+    if tracker.total > 0 and tracker.finished != tracker.total:
+        raise TransferError(f"incomplete download: {tracker.finished}/{tracker.total} bytes received")
+    return tracker.finished
+
+
+def fetch(urls: Union[str, List[str]], dest: str, tag: str = "", options: Optional[TransferOptions] = None,
+          probed: Optional[Tuple[int, bool]] = None) -> int:
+    # probed is the result of probe() on the same urls, if the caller had to know the size beforehand
+    urls = [urls] if isinstance(urls, str) else urls
+    options = options or TransferOptions()
+    part, sidecar = part_paths(dest)
+    state = PartState.load(sidecar)
+    size, ranges = probed or probe(urls, options)
+    if state is not None and not state.same_track(urls[0], size):
+        # another quality or a re-encoded track, the bytes on disk belong to something else
+        state = None
+    if state is not None and state.complete and os.path.exists(dest):
+        return state.size
+
+    tracker = None
+    try:
+        if not ranges or size == 0:
+            # without range support there is nothing to resume from, stream the whole track again
+            state = PartState(sidecar, urls[0], size, [[0, max(size - 1, 0), 0]])
+            tracker = track(options.board, tag, size)
+            failover(urls, options, lambda url: fetch_single(url, part, state, tracker, options))
+        else:
+            resumable = (state is not None) and os.path.exists(part)
+            if resumable:
+                state.url = urls[0]
+            else:
+                segment_count = max(1, min(options.connections, size // MIN_SEGMENT_SIZE))
+                state = PartState(sidecar, urls[0], size,
+                                  [[start, end, 0] for start, end in split(size, segment_count)])
+                with open(part, "wb") as f:
+                    f.truncate(size)
+                state.save()
+            tracker = track(options.board, tag, size, state.written)
+
+            def segment(index: int):
+                # a segment resumes from its own written bytes on the next host
+                failover(urls, options, lambda url: fetch_segment(url, part, state, index, tracker, options))
+
+            with ThreadPoolExecutor(max_workers=len(state.segments), thread_name_prefix="bget-segment") as pool:
+                futures = [pool.submit(segment, index) for index in range(len(state.segments))]
+                for future in futures:
+                    future.result()
+    finally:
+        if options.board is not None and tracker is not None:
+            options.board.finish(tracker)
+    os.replace(part, dest)
+    return state.size
+
+
+def discard(dest: str):
+    for path in (dest, *part_paths(dest)):
+        if os.path.exists(path):
+            os.remove(path)
@@ -1,21 +1,31 @@
-import argparse
 import os
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Union
 from urllib.parse import urlparse, parse_qs
 
-import bgetlib
-
 
 def ensure_file_directory_created(file_path: str):
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
 
+def parse_rate(rate: Union[str, int, float, None]) -> float:
+    # bytes per second, with an optional K/M/G suffix in powers of 1024
+    if rate is None or isinstance(rate, (int, float)):
+        return float(rate or 0)
+    rate = rate.strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if rate[-1:] in units:
+        return float(rate[:-1]) * units[rate[-1]]
+    return float(rate or 0)
+
+
 def list_unique(original_list: list):
     return list(set(original_list))
 
 
 def auto_format(fmt_string: str, video: dict, part_index: Optional[int] = 0, ext: str = ""):
-    title = bgetlib.utils.ntfs_escape(video["title"])
+    # bgetlib pulls in requests, it is left out of the startup of commands not downloading anything
+    from bgetlib.utils import ntfs_escape
+    title = ntfs_escape(video["title"])
     if part_index is None:
         part_index = 0
     kwargs = {
@@ -34,11 +44,11 @@ def auto_format(fmt_string: str, video: dict, part_index: Optional[int] = 0, ext
 
 
 # noinspection PyBroadException
-def parse_resources(args: argparse.Namespace, config_dict: dict) -> Tuple[str, int]:
-    resource_name: str = args.resource.strip()
+def parse_resources(resource_name: str, section: bool, config_dict: dict) -> Tuple[str, int]:
+    resource_name = resource_name.strip()
 
     # section
-    if args.section:
+    if section:
         section = config_dict["section"].get(resource_name) or {}
         fid = section.get("id") or None
         if fid is None:
@@ -65,7 +75,8 @@ def parse_resources(args: argparse.Namespace, config_dict: dict) -> Tuple[str, i
         return "video", int(resource_name[2:])
     if resource_name.lower().startswith("bv"):
         try:
-            aid = bgetlib.utils.bv2av(resource_name)
+            from bgetlib.utils import bv2av
+            aid = bv2av(resource_name)
             return "video", aid
         except:
             pass
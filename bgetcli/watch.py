@@ -0,0 +1,203 @@
+import os
+import copy
+import json
+import time
+import random
+import signal
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+import toml
+
+from .api import BilibiliAPI
+from .archive import Archive
+from .bget import DEFAULT_CONFIG, checkout_videos, download_videos, interleave, list_section, write_metrics
+from .config import Config
+from .jobqueue import QUEUE_FILENAME, JobQueue
+from .plan import Throughput, order_videos
+from .retry import describe_error
+from .runtime import Report, Runtime, SectionHead
+
+# the config file is checked for changes this often while waiting for the next poll
+RELOAD_CHECK = 2.0
+
+
+class Watcher:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.stopping = threading.Event()
+        # api sessions outlive config reloads, so cookies are loaded and connections opened once
+        self.apis: Dict[str, BilibiliAPI] = dict()
+        self.runtimes: Dict[str, Runtime] = dict()
+        self.next_poll: Dict[str, float] = dict()
+        self.sections: Dict[str, dict] = dict()
+        self.running: Optional[str] = None
+        self.started_at = time.time()
+        self.config_mtime = 0.0
+        self.config: Optional[Config] = None
+        self.queue: Optional[JobQueue] = None
+        self.status: Optional[ThreadingHTTPServer] = None
+
+    def log(self, *values):
+        runtime = next(iter(self.runtimes.values()), None)
+        line = f"[{time.strftime('%H:%M:%S')}][watch]" + " ".join(str(value) for value in values)
+        if runtime is not None:
+            runtime.progress.print(line)
+        else:
+            print(line, flush=True)
+
+    def load(self) -> bool:
+        try:
+            mtime = os.stat(self.args.config).st_mtime
+            config_dict = toml.load(self.args.config)
+            config = Runtime.build_config(self.args, copy.deepcopy(DEFAULT_CONFIG), config_dict, None)
+            runtimes = Runtime.factory(self.args, DEFAULT_CONFIG, self.apis)
+        except (Exception, SystemExit) as e:
+            # a broken config keeps the daemon on the last good one
+            self.log(f"Can not load {self.args.config}, keeping the current config: {describe_error(e)}")
+            self.config_mtime = os.stat(self.args.config).st_mtime if os.path.exists(self.args.config) else 0
+            return False
+        self.close_runtimes()
+        self.config_mtime = mtime
+        self.config = config
+        self.runtimes = {runtime.section_name: runtime for runtime in runtimes}
+        self.reopen_archives()
+        if self.queue is None:
+            self.queue = JobQueue(os.path.join(config.cache, QUEUE_FILENAME))
+        now = time.time()
+        for name, runtime in self.runtimes.items():
+            interval = runtime.config.watch_interval
+            if name not in self.next_poll or self.sections[name]["interval"] != interval:
+                # the first polls are spread over the jitter window, so sections do not start together
+                self.next_poll[name] = now + random.uniform(0, interval * runtime.config.watch_jitter)
+            self.sections.setdefault(name, {"last_poll_at": None, "listed": 0, "failed": 0, "error": None})
+            self.sections[name]["interval"] = interval
+        for name in list(self.next_poll.keys()):
+            if name not in self.runtimes:
+                del self.next_poll[name]
+                del self.sections[name]
+        self.log(f"Watching {len(self.runtimes)} sections of {self.args.config}")
+        return True
+
+    def close_runtimes(self):
+        if len(self.runtimes) == 0:
+            return
+        runtime = next(iter(self.runtimes.values()))
+        runtime.scheduler.shutdown()
+        runtime.meta.close()
+        runtime.progress.close()
+        Archive.close_all()
+
+    def reopen_archives(self):
+        # bundles are closed after every cycle so their index is on disk, the next cycle appends again
+        Archive.close_all()
+        for runtime in self.runtimes.values():
+            if runtime.config.archive is not None:
+                runtime.archive = Archive.open(runtime.config.outdir, runtime.section_name, runtime.config.archive)
+
+    def cycle(self, name: str):
+        runtime = self.runtimes[name]
+        state = self.sections[name]
+        self.running = name
+        runtime.report = Report()
+        runtime.failed = list()
+        runtime.retry.reset()
+        runtime.meta.reset()
+        transferred = runtime.metrics.transferred()
+        try:
+            section_head, favorite_sync, tasks = list_section(runtime)
+            # the whole listing is queued before the head moves on
+            tasks = list(tasks)
+            self.queue.add(name, tasks)
+            SectionHead.write_all([section_head])
+            if favorite_sync is not None:
+                favorite_sync.commit()
+            queued = self.queue.pending(name)
+            runtime.log(f"{len(tasks)} new items, {len(queued)} in queue")
+            videos = order_videos(runtime, checkout_videos(runtime, queued))
+            interleave([download_videos(runtime, videos, len(queued))])
+            runtime.scheduler.wait()
+            failed = set(entry.id for entry in runtime.failed)
+            for task in self.queue.finish(name, failed):
+                runtime.log(f"Giving up av{task['id']} after {task['attempts']} attempts")
+            state.update(listed=len(tasks), failed=len(failed), error=None)
+        except Exception as e:
+            # the section is polled again on its next turn, the queued items are kept
+            state["error"] = describe_error(e)
+            runtime.log(f"Cycle failed: {state['error']}")
+        finally:
+            runtime.meta.flush()
+            self.reopen_archives()
+            write_metrics(runtime)
+            size, seconds = runtime.metrics.transferred()
+            Throughput(self.config.cache).record(size - transferred[0], seconds - transferred[1])
+            self.running = None
+            state["last_poll_at"] = time.time()
+            jitter = runtime.config.watch_jitter
+            self.next_poll[name] = time.time() + state["interval"] * random.uniform(1 - jitter, 1 + jitter)
+
+    def snapshot(self) -> dict:
+        runtime = next(iter(self.runtimes.values()), None)
+        depth = self.queue.depth() if self.queue is not None else {}
+        return {
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "config": os.path.abspath(self.args.config),
+            "running": self.running,
+            "queue_depth": sum(depth.values()),
+            "sections": {name: dict(state, next_poll_at=self.next_poll.get(name), queued=depth.get(name, 0))
+                         for name, state in self.sections.items()},
+            "workers": runtime.metrics.summary()["queues"] if runtime is not None else {},
+        }
+
+    def serve_status(self, port: int):
+        watcher = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(watcher.snapshot(), indent=4).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *_):
+                pass
+
+        # local only, the status tells which folders are synced
+        try:
+            self.status = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        except OSError as e:
+            self.log(f"Can not serve the status on port {port}: {describe_error(e)}")
+            return
+        self.status.daemon_threads = True
+        threading.Thread(target=self.status.serve_forever, name="bget-status", daemon=True).start()
+        self.log(f"Status on http://127.0.0.1:{self.status.server_port}/")
+
+    def run(self):
+        if not self.load():
+            return
+        if self.config.status_port > 0:
+            self.serve_status(self.config.status_port)
+        signal.signal(signal.SIGTERM, lambda *_: self.stopping.set())
+        try:
+            while not self.stopping.is_set():
+                if os.path.exists(self.args.config) and os.stat(self.args.config).st_mtime != self.config_mtime:
+                    self.log("Config changed, reloading")
+                    self.load()
+                name = min(self.next_poll, key=self.next_poll.get, default=None)
+                wait = self.next_poll[name] - time.time() if name is not None else RELOAD_CHECK
+                if wait > 0:
+                    self.stopping.wait(min(wait, RELOAD_CHECK))
+                    continue
+                self.cycle(name)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.log("Stopping")
+            if self.status is not None:
+                self.status.shutdown()
+            self.close_runtimes()
@@ -0,0 +1,53 @@
+import os
+import sys
+import shutil
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the package is tested from the checkout, the fake servers of the benchmarks are shared with the tests
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import fakebili  # noqa: E402
+
+
+@pytest.fixture
+def cdn():
+    # starts a fake stream host serving the given bytes as a track, returns its url, behaviour and tracks
+    servers = list()
+
+    def start(data: bytes, **behaviour):
+        behaviour = fakebili.Behaviour(**behaviour)
+        tracks = {"video": data, "audio": data}
+        server = fakebili.listen(0, tracks, behaviour)
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}/stream/1/video.m4s", behaviour, tracks
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(scope="session")
+def bili():
+    # the fake api and CDN with small real tracks, the merges need ffmpeg
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("ffmpeg is not installed")
+    server = fakebili.serve(0, fakebili.Behaviour(), 256 * 1024, 64 * 1024)
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def run_bget(base: str, workdir: str, config: str, *args: str) -> subprocess.CompletedProcess:
+    # a whole run in its own process, like the pipeline benchmark
+    with open(os.path.join(workdir, "bget.toml"), "w", encoding="utf-8") as f:
+        f.write(config)
+    env = dict(os.environ, BGET_API_BASE=base, BGET_COMMENT_BASE=base,
+               PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    return subprocess.run([sys.executable, "-m", "bgetcli.bget", "--config", "bget.toml", "--progress", "none",
+                           *args], cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          timeout=300, encoding="utf-8", errors="replace")
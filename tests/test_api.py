@@ -0,0 +1,12 @@
+from bgetcli.api import BilibiliAPI
+
+COOKIES = "# Netscape HTTP Cookie File\n.bilibili.com\tTRUE\t/\tFALSE\t0\t{name}\t{value}\n"
+
+
+def test_account_comes_from_the_cookies(tmp_path):
+    cookies = tmp_path / "cookies.txt"
+    cookies.write_text(COOKIES.format(name="DedeUserID", value="36081646"))
+    assert BilibiliAPI(str(cookies)).account == "36081646"
+    cookies.write_text(COOKIES.format(name="buvid3", value="guest-device"))
+    assert BilibiliAPI(str(cookies)).account == "guest"
+    assert BilibiliAPI().account == "guest"
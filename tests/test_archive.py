@@ -0,0 +1,88 @@
+import os
+import sys
+import subprocess
+
+import pytest
+
+from bgetcli.archive import ARCHIVE_FORMATS, Archive
+from conftest import ROOT
+
+
+def crash_after_adding(path: str, archive_format: str, names):
+    # the process dies without closing the archive, like a killed run
+    script = ("import os, sys; from bgetcli.archive import Archive; "
+              f"archive = Archive({path!r}, {archive_format!r}); "
+              f"[archive.add(name, name.encode()) for name in {list(names)!r}]; "
+              "(archive.file.fp if archive.format == 'zip' else archive.file).flush(); os._exit(0)")
+    subprocess.run([sys.executable, "-c", script], check=True, cwd=ROOT)
+
+
+@pytest.mark.parametrize("archive_format", ARCHIVE_FORMATS)
+def test_read_after_reopen(tmp_path, archive_format):
+    path = str(tmp_path / f"bget.{archive_format}")
+    archive = Archive(path, archive_format)
+    archive.add("a/1.xml", "弹幕".encode("utf-8"))
+    archive.add("a/1.jpg", b"\xff\xd8\xff", compress=False)
+    assert archive.read("a/1.xml") == "弹幕".encode("utf-8")
+    archive.close()
+
+    archive = Archive(path, archive_format)
+    assert archive.has("a/1.xml") and archive.has("a/1.jpg")
+    assert archive.read("a/1.jpg") == b"\xff\xd8\xff"
+    archive.add("a/2.xml", b"<i></i>")
+    assert archive.read("a/1.xml") == "弹幕".encode("utf-8")
+    archive.close()
+
+
+def test_zip_recovers_entries_after_crash(tmp_path):
+    path = str(tmp_path / "bget.zip")
+    archive = Archive(path, "zip")
+    archive.add("old.xml", b"old")
+    archive.close()
+
+    crash_after_adding(path, "zip", ["new1.xml", "new2.xml"])
+    with open(path, "ab") as f:
+        f.write(b"PK\x03\x04 cut short")
+    archive = Archive(path, "zip")
+    assert archive.read("old.xml") == b"old"
+    assert archive.read("new2.xml") == b"new2.xml"
+    archive.add("new3.xml", b"new3")
+    archive.close()
+
+    archive = Archive(path, "zip")
+    assert sorted(archive.entries) == ["new1.xml", "new2.xml", "new3.xml", "old.xml"]
+    archive.close()
+
+
+def test_zip_is_appended_in_place(tmp_path):
+    path = str(tmp_path / "bget.zip")
+    archive = Archive(path, "zip")
+    archive.add("old.xml", bytes(64 * 1024), compress=False)
+    archive.close()
+    inode = os.stat(path).st_ino
+    archive = Archive(path, "zip")
+    archive.add("new.xml", b"new")
+    archive.close()
+    assert os.stat(path).st_ino == inode
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_jsonl_recovers_records_after_crash(tmp_path):
+    path = str(tmp_path / "bget.jsonl.gz")
+    archive = Archive(path, "jsonl")
+    archive.add("old.xml", b"old")
+    archive.close()
+
+    crash_after_adding(path, "jsonl", ["new1.xml", "new2.xml"])
+    with open(path, "ab") as f:
+        f.write(b"\x1f\x8b\x08\x00 cut short")
+    archive = Archive(path, "jsonl")
+    assert archive.read("old.xml") == b"old"
+    assert archive.read("new2.xml") == b"new2.xml"
+    archive.add("new3.xml", b"new3")
+    archive.close()
+
+    archive = Archive(path, "jsonl")
+    assert sorted(archive.entries) == ["new1.xml", "new2.xml", "new3.xml", "old.xml"]
+    assert archive.read("new3.xml") == b"new3"
+    archive.close()
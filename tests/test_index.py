@@ -0,0 +1,28 @@
+import os
+
+from bgetcli.index import CompletionIndex
+
+
+def test_done_requires_the_expected_output(tmp_path):
+    index = CompletionIndex(str(tmp_path / "index.sqlite3"))
+    saved = tmp_path / "av1-P001 Video 1.aac"
+    saved.write_bytes(b"audio")
+    index.record(1, 10, "audio", str(saved))
+    # audio and covers get their extension after the download
+    assert index.done(1, 10, "audio", str(tmp_path / "av1-P001 Video 1."))
+    assert index.done(1, 10, "audio", str(saved))
+    # a formatter change or another section with its own formatter expects another file
+    assert not index.done(1, 10, "audio", str(tmp_path / "audio" / "av1-P001 Video 1."))
+    assert not index.done(1, 10, "audio", str(tmp_path / "av1-P001 Video"))
+    assert not index.done(1, 11, "audio", str(saved))
+
+
+def test_done_requires_the_recorded_file(tmp_path):
+    index = CompletionIndex(str(tmp_path / "index.sqlite3"))
+    saved = tmp_path / "av1.mp4"
+    saved.write_bytes(b"video")
+    index.record(1, 10, "video", str(saved))
+    saved.write_bytes(b"changed video")
+    assert not index.done(1, 10, "video", str(saved))
+    os.remove(saved)
+    assert not index.done(1, 10, "video", str(saved))
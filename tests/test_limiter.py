@@ -0,0 +1,42 @@
+import collections
+import shutil
+import threading
+import time
+
+import pytest
+
+from bgetcli.limiter import DiskSpace, DiskSpaceError
+
+Usage = collections.namedtuple("Usage", "total used free")
+
+
+@pytest.fixture
+def free(monkeypatch):
+    space = {"free": 0}
+    monkeypatch.setattr(shutil, "disk_usage", lambda path: Usage(0, 0, space["free"]))
+    monkeypatch.setattr(DiskSpace, "POLL_INTERVAL", 0.05)
+    return space
+
+
+def test_part_waits_for_space_freed_outside(tmp_path, free):
+    space = DiskSpace(100, timeout=5)
+    free["free"] = 150
+    waited = []
+    timer = threading.Timer(0.3, free.update, [{"free": 1000}])
+    timer.start()
+    reservation = space.reserve({str(tmp_path): 200}, waited.append)
+    timer.join()
+    assert len(waited) == 1 and waited[0].startswith("Waiting for disk space")
+    assert list(reservation.values()) == [200]
+    space.release(reservation)
+    assert list(space.reserved.values()) == [0]
+
+
+def test_part_fails_after_the_timeout(tmp_path, free):
+    space = DiskSpace(100, timeout=0.2)
+    free["free"] = 150
+    started = time.monotonic()
+    with pytest.raises(DiskSpaceError, match="not enough disk space"):
+        space.reserve({str(tmp_path): 200})
+    assert 0.2 <= time.monotonic() - started < 2
+    assert space.reserved == {}
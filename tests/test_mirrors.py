@@ -0,0 +1,72 @@
+import io
+import json
+import os
+from urllib.parse import urlparse
+
+from bgetcli import mirrors, transfer
+from bgetcli.mirrors import HostRanking
+from bgetcli.transfer import MIN_SEGMENT_SIZE, TransferOptions
+
+STALL_AFTER = 64 * 1024
+
+
+def host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+def test_stalled_host_fails_over_with_the_written_bytes(cdn, tmp_path):
+    data = os.urandom(2 * MIN_SEGMENT_SIZE)
+    stalled, stalled_behaviour, _ = cdn(data, cut_after=STALL_AFTER, stalled=True)
+    healthy, healthy_behaviour, _ = cdn(data)
+    dest = str(tmp_path / "track.m4s")
+    switched = list()
+    options = TransferOptions(stall_timeout=0.3, on_stall=switched.append)
+    assert transfer.fetch([stalled, healthy], dest, options=options) == len(data)
+    with open(dest, "rb") as f:
+        assert f.read() == data
+    assert switched == [stalled]
+    # the next host is asked for the rest of the segment only
+    start, end = healthy_behaviour.streamed[-1][len("bytes="):].split("-")
+    assert 0 < int(start) <= STALL_AFTER and int(end) == len(data) - 1
+
+
+def test_piped_stream_continues_on_the_next_host(cdn):
+    data = os.urandom(MIN_SEGMENT_SIZE)
+    stalled, _, _ = cdn(data, cut_after=STALL_AFTER, stalled=True)
+    healthy, healthy_behaviour, _ = cdn(data)
+    output = io.BytesIO()
+    options = TransferOptions(stall_timeout=0.3)
+    assert transfer.stream([stalled, healthy], output, options=options) == len(data)
+    assert output.getvalue() == data
+    # the bytes already handed to the output are not asked for again
+    assert len(healthy_behaviour.streamed) == 1
+    start, end = healthy_behaviour.streamed[0][len("bytes="):].split("-")
+    assert 0 < int(start) <= STALL_AFTER and end == ""
+
+
+def test_stalled_host_is_demoted(cdn, tmp_path):
+    data = os.urandom(MIN_SEGMENT_SIZE)
+    servers = dict()
+    for _ in range(2):
+        url, behaviour, _ = cdn(data)
+        servers[host(url)] = behaviour
+    ranking = HostRanking(str(tmp_path), list(servers), 3600)
+    ranked = ranking.rank(url)
+    servers[ranked[0]].cut_after = STALL_AFTER
+    servers[ranked[0]].stalled = True
+
+    urls = mirrors.alternatives(url, ranked)
+    options = TransferOptions(stall_timeout=0.3, on_stall=ranking.demote)
+    transfer.fetch(urls, str(tmp_path / "track.m4s"), options=options)
+    assert ranking.rank(url) == [ranked[1], ranked[0]]
+    # the demotion outlives the process until the ranking expires
+    assert HostRanking(str(tmp_path), list(servers), 3600).rank(url) == [ranked[1], ranked[0]]
+
+
+def test_broken_ranking_cache_is_probed_again(cdn, tmp_path):
+    url, _, _ = cdn(os.urandom(1024))
+    cache = tmp_path / mirrors.RANKING_FILENAME
+    for content in ['{"probed_at": 1e12, "res', '[]', '{"results": []}', '{"probed_at": 1e12, "results": [1]}']:
+        cache.write_text(content)
+        assert HostRanking(str(tmp_path), [host(url)], 3600).rank(url) == [host(url)]
+        assert json.loads(cache.read_text())["results"][0]["host"] == host(url)
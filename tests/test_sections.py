@@ -0,0 +1,54 @@
+import os
+import json
+
+from conftest import run_bget
+
+
+def outputs(folder: str, extension: str):
+    return sorted(name for name in os.listdir(folder) if name.endswith(extension))
+
+
+def test_sections_sharing_an_outdir(bili, tmp_path):
+    # both sections stage the tracks of the same parts at the same time
+    config = ("jobs = 4\n"
+              "[section.video]\nid = 10\noutdir = \"out\"\nswitches = [\"video\"]\n"
+              "[section.audio]\nid = 10\noutdir = \"out\"\nswitches = [\"audio\"]\n")
+    result = run_bget(bili, str(tmp_path), config, "--all-sections")
+    assert result.returncode == 0, result.stdout
+    assert "    Error: 0\n" in result.stdout, result.stdout
+    # ten videos, every fifth has two parts
+    assert len(outputs(str(tmp_path / "out"), ".mp4")) == 12
+    assert len(outputs(str(tmp_path / "out"), ".aac")) == 12
+    assert not any(name.endswith((".m4s", ".part", ".part.json")) for _, _, names in os.walk(tmp_path / "out")
+                   for name in names)
+
+
+def test_failed_listing_keeps_the_queue(cdn, tmp_path):
+    # every request of this api fails, the folder can not be listed
+    url, _, _ = cdn(b"", error_rate=1.0)
+    base = url.split("/stream/", 1)[0]
+    queued = {"one": [{"id": 1001, "title": "Video 1001", "attempts": 1}]}
+    os.makedirs(tmp_path / ".bget-cache")
+    with open(tmp_path / ".bget-cache" / "queue.json", "w", encoding="utf-8") as f:
+        json.dump(queued, f)
+    result = run_bget(base, str(tmp_path), "retries = 0\n[section.one]\nid = 5\nswitches = [\"meta\"]\n",
+                      "--all-sections")
+    assert result.returncode == 0, result.stdout
+    assert "listing: " in result.stdout, result.stdout
+    with open(tmp_path / ".bget-cache" / "queue.json", encoding="utf-8") as f:
+        assert json.load(f) == queued
+    assert not os.path.exists(tmp_path / "head.json")
+
+
+def test_plan_goes_on_after_a_failed_listing(bili, tmp_path):
+    config = ("retries = 0\n"
+              "[section.gone]\nid = -1\nswitches = [\"meta\"]\n"
+              "[section.one]\nid = 5\nswitches = [\"audio\"]\n")
+    result = run_bget(bili, str(tmp_path), config, "--all-sections", "--plan")
+    assert result.returncode == 0, result.stdout
+    assert "listing: " in result.stdout, result.stdout
+    assert "gone (listing failed" in result.stdout, result.stdout
+    assert "one: 5 videos to download" in result.stdout, result.stdout
+    # a dry run does not start a download
+    assert "Start downloading at" not in result.stdout, result.stdout
+    assert not os.path.exists(tmp_path / "head.json")
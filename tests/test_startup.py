@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+from bgetcli import ffmpeg
+from conftest import ROOT
+from import_time import FORBIDDEN
+
+
+def test_entry_point_leaves_the_download_stack_unloaded():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    check = f"import sys, bgetcli.bget; print(','.join(m for m in {FORBIDDEN!r} if m in sys.modules))"
+    output = subprocess.run([sys.executable, "-c", check], capture_output=True, env=env, check=True)
+    assert output.stdout.decode().strip() == ""
+
+
+def test_ffmpeg_is_located_again_on_another_path(tmp_path, monkeypatch):
+    for name in ["one", "two"]:
+        folder = tmp_path / name
+        folder.mkdir()
+        binary = folder / "ffmpeg"
+        binary.write_text(f"#!/bin/sh\necho 'ffmpeg version {name} Copyright'\n")
+        binary.chmod(0o755)
+    # locate hands the binary to the merge workers through the environment
+    monkeypatch.setenv(ffmpeg.PATH_ENVIRON, "")
+    monkeypatch.setenv("PATH", str(tmp_path / "one"))
+    assert ffmpeg.locate(str(tmp_path / "cache"))["version"] == "ffmpeg version one"
+    monkeypatch.setenv("PATH", str(tmp_path / "two"))
+    assert ffmpeg.locate(str(tmp_path / "cache"))["version"] == "ffmpeg version two"
+    assert ffmpeg.locate(str(tmp_path / "cache"))["path"] == str(tmp_path / "two" / "ffmpeg")
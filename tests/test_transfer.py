@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from bgetcli import transfer
+from bgetcli.transfer import MIN_SEGMENT_SIZE, PartState, TransferError, TransferOptions
+
+
+def read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_resume_from_part(cdn, tmp_path):
+    data = os.urandom(2 * MIN_SEGMENT_SIZE)
+    url, behaviour, _ = cdn(data, cut_after=300 * 1024)
+    dest = str(tmp_path / "track.m4s")
+    options = TransferOptions(connections=2)
+    with pytest.raises(TransferError):
+        transfer.fetch(url, dest, options=options)
+    part, sidecar = transfer.part_paths(dest)
+    state = PartState.load(sidecar)
+    assert os.path.exists(part) and not os.path.exists(dest)
+    assert [written for _, _, written in state.segments] == [300 * 1024, 300 * 1024]
+
+    behaviour.cut_after = None
+    behaviour.streamed.clear()
+    assert transfer.fetch(url, dest, options=options) == len(data)
+    assert read(dest) == data
+    # every segment goes on from its own written bytes
+    resumed = set(requested for requested in behaviour.streamed if requested != "bytes=0-0")
+    assert resumed == set(f"bytes={start + written}-{end}" for start, end, written in state.segments)
+
+
+def test_complete_track_is_reused(cdn, tmp_path):
+    data = os.urandom(MIN_SEGMENT_SIZE)
+    url, behaviour, _ = cdn(data)
+    dest = str(tmp_path / "track.m4s")
+    transfer.fetch(url, dest)
+    behaviour.streamed.clear()
+    assert transfer.fetch(url, dest) == len(data)
+    assert behaviour.streamed == ["bytes=0-0"]
+
+
+def test_complete_track_of_another_size_is_fetched_again(cdn, tmp_path):
+    url, behaviour, tracks = cdn(os.urandom(MIN_SEGMENT_SIZE))
+    dest = str(tmp_path / "track.m4s")
+    transfer.fetch(url, dest)
+    # the api handed out another quality of the same part
+    tracks["video"] = os.urandom(MIN_SEGMENT_SIZE + 4096)
+    assert transfer.fetch(url, dest) == len(tracks["video"])
+    assert read(dest) == tracks["video"]
+
+
+def test_part_of_another_track_is_not_resumed(cdn, tmp_path):
+    data = os.urandom(2 * MIN_SEGMENT_SIZE)
+    url, behaviour, _ = cdn(data, cut_after=300 * 1024)
+    dest = str(tmp_path / "track.m4s")
+    with pytest.raises(TransferError):
+        transfer.fetch(url, dest)
+    behaviour.cut_after = None
+    behaviour.streamed.clear()
+    other = url.replace("/stream/1/", "/stream/2/")
+    assert transfer.fetch(other, dest) == len(data)
+    assert behaviour.streamed == ["bytes=0-0", f"bytes=0-{len(data) - 1}"]
+
+
+@pytest.mark.parametrize("size, connections", [(1, 4), (MIN_SEGMENT_SIZE, 3), (10 * MIN_SEGMENT_SIZE + 7, 4),
+                                               (5 * MIN_SEGMENT_SIZE, 5), (12345, 1)])
+def test_split_covers_every_byte_once(size, connections):
+    segments = transfer.split(size, connections)
+    assert 0 < len(segments) <= connections
+    assert segments[0][0] == 0 and segments[-1][1] == size - 1
+    for (_, end), (start, _) in zip(segments, segments[1:]):
+        assert start == end + 1
+
+
+def test_segments_are_fetched_at_their_offsets(cdn, tmp_path):
+    data = os.urandom(4 * MIN_SEGMENT_SIZE + 12345)
+    url, behaviour, _ = cdn(data)
+    dest = str(tmp_path / "track.m4s")
+    assert transfer.fetch(url, dest, options=TransferOptions(connections=4)) == len(data)
+    assert read(dest) == data
+    assert behaviour.streamed[0] == "bytes=0-0"
+    assert sorted(behaviour.streamed[1:]) == sorted(f"bytes={start}-{end}"
+                                                    for start, end in transfer.split(len(data), 4))
+
+
+def test_small_track_is_not_split(cdn, tmp_path):
+    data = os.urandom(MIN_SEGMENT_SIZE + 1)
+    url, behaviour, _ = cdn(data)
+    dest = str(tmp_path / "track.m4s")
+    transfer.fetch(url, dest, options=TransferOptions(connections=8))
+    assert behaviour.streamed == ["bytes=0-0", f"bytes=0-{len(data) - 1}"]
+
+
+def test_without_range_support_the_track_is_streamed_once(cdn, tmp_path):
+    data = os.urandom(4 * MIN_SEGMENT_SIZE)
+    url, behaviour, _ = cdn(data, ranges=False)
+    dest = str(tmp_path / "track.m4s")
+    assert transfer.probe([url], TransferOptions()) == (len(data), False)
+    behaviour.streamed.clear()
+    assert transfer.fetch(url, dest, options=TransferOptions(connections=4)) == len(data)
+    assert read(dest) == data
+    # the probe asks for a range, the download itself is one plain request
+    assert behaviour.streamed == ["bytes=0-0", None]
+    state = PartState.load(transfer.part_paths(dest)[1])
+    assert state.segments == [[0, len(data) - 1, len(data)]]
+
+
+def test_without_range_support_an_interrupted_track_starts_over(cdn, tmp_path):
+    data = os.urandom(2 * MIN_SEGMENT_SIZE)
+    url, behaviour, _ = cdn(data, ranges=False, cut_after=300 * 1024)
+    dest = str(tmp_path / "track.m4s")
+    with pytest.raises(TransferError):
+        transfer.fetch(url, dest)
+    behaviour.cut_after = None
+    behaviour.streamed.clear()
+    assert transfer.fetch(url, dest) == len(data)
+    assert read(dest) == data
+    assert behaviour.streamed == ["bytes=0-0", None]